@@ -1,18 +1,61 @@
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import ttk
-from PIL import Image, ImageTk
+import argparse
+import json
 import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from utils import (
-    import_photo_metadata,
+    CACHE_DIR,
+    CARD_READER_WORKERS,
     group_by_date,
     find_existing_images,
     raw_extensions,
+    IndexReader,
+    IndexSnapshot,
+    find_date_coverage,
+    coverage_status,
 )
-from app_import_window import ImportWindow
+from card_cache import (
+    CardCache,
+    card_key,
+    index_signature,
+    iter_card_capture_times,
+    listing_digest,
+)
+from profiling import profiled, stats
+
+# PIL, the thumbnail modules, EXIF parsing and the import window are imported
+# where they are first used, so the window appears without waiting for them
+
+# The databases selected last time, opened again at startup
+SETTINGS_FILE = os.path.join(CACHE_DIR, "app_settings.json")
+
+
+def load_databases():
+    try:
+        with open(SETTINGS_FILE) as f:
+            databases = json.load(f).get("databases", [])
+    except (OSError, ValueError):
+        return []
+    missing = [database for database in databases if not os.path.exists(database)]
+    for database in missing:
+        print("Database not found:", database)
+    return [database for database in databases if database not in missing]
+
+
+def save_databases(databases):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(SETTINGS_FILE, "w") as f:
+        json.dump({"databases": list(databases)}, f)
 
 
 def display_jpg_files(folder_path):
+    from PIL import Image, ImageTk
+
     for widget in image_frame.winfo_children():
         widget.destroy()
 
@@ -47,78 +90,264 @@ def select_database():
         print("No database selected")
 
 
-def toggle_pane(date, files, pane, button):
+def toggle_pane(date, files, pane, button, thumbnail_loader):
     if len(pane.winfo_children()) > 1:
         for widget in pane.winfo_children()[1:]:
             widget.destroy()
         button.config(text="Show")
     else:
         button.config(text="Hide")
-        display_images(date, files, pane)
-
-
-def display_images(date, files, pane):
-    img_frame = ttk.Frame(pane)
-    img_frame.pack(fill=tk.X, padx=5, pady=2)
-
-    canvas = tk.Canvas(img_frame, height=200, width=700)  # Adjust height as needed
-    canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        display_images(date, files, pane, thumbnail_loader)
 
-    scrollbar = ttk.Scrollbar(img_frame, orient=tk.VERTICAL, command=canvas.yview)
-    scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
-    canvas.configure(yscrollcommand=scrollbar.set)
+def display_images(date, files, pane, thumbnail_loader):
+    from thumbnail_grid import ThumbnailGrid
 
-    inner_frame = ttk.Frame(canvas)
-    canvas.create_window((0, 0), window=inner_frame, anchor="nw")
-
-    row, col = 0, 0
-    for filepath in files[:10]:
-        img = Image.open(filepath)
-        img.thumbnail((150, 150))
-        img = ImageTk.PhotoImage(img)
-
-        label = tk.Label(inner_frame, image=img)
-        label.image = img
-        label.grid(row=row, column=col, padx=10, pady=10)
-
-        col += 1
-        if col == 4:
-            col = 0
-            row += 1
-
-    inner_frame.update_idletasks()
-    canvas.configure(scrollregion=canvas.bbox("all"))
+    grid = ThumbnailGrid(
+        pane, files, thumbnail_loader, size=(150, 150), columns=4, height=200
+    )
+    grid.pack(fill=tk.X, padx=5, pady=2)
 
 
 class App:
     def select_database(self):
-        db_path = filedialog.askopenfilename(
+        # Several databases can be picked when the index is split into shards;
+        # imports are written to the first one
+        db_paths = filedialog.askopenfilenames(
             filetypes=[("SQLite Database", "*.sqlite")]
         )
-        self.db_path = db_path
-        if db_path:
-            print("Selected database:", db_path)
-            self.db_info_label.config(text=f"DB Path: {self.db_path}")
-        else:
+        if not db_paths:
+            # Cancelled, keep the databases already open
             print("No database selected")
+            return
+        self.db_shards = list(db_paths)
+        self.db_path = self.db_shards[0]
+        self.unique_by_file = {}
+        save_databases(self.db_shards)
+        print("Selected database:", ", ".join(db_paths))
+        self.db_info_label.config(text=self.db_label())
+        self.open_index()
+
+    def db_label(self):
+        return f"DB Path: {', '.join(self.db_shards) or 'none selected'}"
+
+    def open_index(self):
+        """Open the shared read-only connection and load the snapshot of the selected databases.
+
+        Both happen on a background thread. Lookups made before the connection
+        is open wait for it rather than opening their own, and lookups made
+        before the snapshot is loaded query the index instead.
+        """
+        if self.index_reader is not None:
+            self.index_reader.close()
+        if self.db_path is None:
+            self.index_reader = None
+            self.index_snapshot = None
+            return
+        reader = IndexReader(self.db_shards)
+        snapshot = IndexSnapshot(self.db_shards)
+        self.index_reader = reader
+        self.index_snapshot = snapshot
+
+        def load():
+            try:
+                with stats.stage("index_open"):
+                    reader.connect()
+                    snapshot.refresh()
+            except sqlite3.Error as e:
+                print(f"Error opening database: {e}")
+
+        threading.Thread(target=load, daemon=True).start()
+
+    def get_thumbnail_loader(self):
+        if self.thumbnail_loader is None:
+            from thumbnails import ThumbnailLoader
+
+            self.thumbnail_loader = ThumbnailLoader(self.root)
+        return self.thumbnail_loader
 
     def select_folder(
         self,
     ):
         folder_path = filedialog.askdirectory()
         if folder_path:
-            contents = import_photo_metadata(folder_path)  # , {"jpg", "jpeg"})
-            grouped_files = group_by_date(contents)
-            self.display_dates(grouped_files)
+            self.scan_card(folder_path)
         else:
             print("No folder selected")
 
-    def display_dates(self, grouped_files):
+    def scan_card(self, folder_path):
+        """Scan the card on a background thread, redrawing the dates as each folder is read.
+
+        A card scanned before is shown from the card cache straight away, and
+        the scan then only reads the files that were added or changed since.
+        """
+        if self.card_cache is None:
+            from exif import MetadataCache
+
+            self.metadata_cache = MetadataCache()
+            self.card_cache = CardCache()
+        folder_path = os.path.abspath(folder_path)
+        self.scan_id += 1
+        scan_id = self.scan_id
+        self.clear_dates()
+        self.card_contents = {}
+        self.unique_by_file = {}
+        self.card_listing = {}
+        key = card_key(folder_path)
+        cached = self.card_cache.load(key)
+        cached_files = cached[2] if cached is not None else {}
+        if cached_files:
+            self.card_contents = {
+                os.path.join(folder_path, relative_path): capture_time
+                for relative_path, (_, _, capture_time, _) in cached_files.items()
+            }
+            # Index checks are only still valid if the index hasn't changed
+            if cached[1] is not None and cached[1] == index_signature(self.index_snapshot):
+                self.unique_by_file = {
+                    os.path.join(folder_path, relative_path): is_unique
+                    for relative_path, (_, _, _, is_unique) in cached_files.items()
+                    if is_unique is not None
+                }
+            with stats.stage("display_dates"):
+                self.display_dates(group_by_date(self.card_contents))
+        results = queue.Queue()
+
+        def scan():
+            error = None
+            try:
+                with stats.stage("card_scan", folder_path), ThreadPoolExecutor(
+                    max_workers=CARD_READER_WORKERS
+                ) as executor:
+                    for contents, listing in iter_card_capture_times(
+                        folder_path, cached_files, self.metadata_cache, executor
+                    ):
+                        if scan_id != self.scan_id:
+                            return
+                        results.put((contents, listing))
+            except Exception as e:
+                error = e
+                print(f"Error scanning {folder_path}: {e}")
+            finally:
+                # Always ends poll_scan, with the error if the scan failed
+                results.put(error)
+
+        threading.Thread(target=scan, daemon=True).start()
+        self.root.after(
+            50, self.poll_scan, scan_id, results, folder_path, key, cached
+        )
+
+    def poll_scan(self, scan_id, results, folder_path, key, cached):
+        if scan_id != self.scan_id:
+            return
+        finished = False
+        failed = False
+        updated = False
+        while True:
+            try:
+                result = results.get_nowait()
+            except queue.Empty:
+                break
+            if result is None or isinstance(result, Exception):
+                finished = True
+                failed = result is not None
+                break
+            contents, listing = result
+            self.card_listing.update(listing)
+            # Files unchanged since the cached scan are already on screen
+            if any(self.card_contents.get(file) != time for file, time in contents.items()):
+                self.card_contents.update(contents)
+                updated = True
+        if finished and not failed:
+            # Drop cached files that are no longer on the card
+            on_card = {
+                os.path.join(folder_path, relative_path)
+                for relative_path in self.card_listing
+            }
+            removed = [file for file in self.card_contents if file not in on_card]
+            for file in removed:
+                del self.card_contents[file]
+            updated = updated or bool(removed)
+        if updated:
+            with stats.stage("display_dates"):
+                self.display_dates(group_by_date(self.card_contents))
+        if not finished:
+            self.root.after(
+                50, self.poll_scan, scan_id, results, folder_path, key, cached
+            )
+        elif not failed:
+            # A failed scan's listing is partial, so the cached one is kept
+            self.save_card(folder_path, key, cached)
+
+    def save_card(self, folder_path, key, cached):
+        def relative(file):
+            return os.path.relpath(file, folder_path).replace(os.sep, "/")
+
+        signature = index_signature(self.index_snapshot)
+        capture_times = {relative(file): time for file, time in self.card_contents.items()}
+        unique_by_file = {
+            relative(file): is_unique
+            for file, is_unique in self.unique_by_file.items()
+        }
+        if cached is not None and cached[1] == signature:
+            # Skip the write when neither the card nor the index changed
+            cached_unique = {
+                relative_path: entry[3]
+                for relative_path, entry in cached[2].items()
+                if entry[3] is not None
+            }
+            if (
+                cached[0] == listing_digest(self.card_listing)
+                and cached_unique == unique_by_file
+            ):
+                return
+        self.card_cache.save(
+            key, self.card_listing, capture_times, unique_by_file, signature
+        )
+
+    def clear_dates(self):
         for widget in date_canvas_frame.winfo_children():
             widget.destroy()
+        self.date_panes = {}
+
+    def display_dates(self, grouped_files):
+        """Show a pane for each date, updating the panes already shown in place.
+
+        Only dates whose files changed since the last call are checked against
+        the index and have their header redrawn, and panes that are open stay open.
+        """
+        for date in [date for date in self.date_panes if date not in grouped_files]:
+            self.date_panes.pop(date)["pane"].destroy()
+        changed = {
+            date: files
+            for date, files in grouped_files.items()
+            if date not in self.date_panes or self.date_panes[date]["files"] != files
+        }
+        if not changed:
+            return
+
+        # Check the files found since the last redraw against the index at once
+        if self.db_path is not None:
+            unchecked = [
+                file
+                for files in changed.values()
+                for file in files
+                if file not in self.unique_by_file
+            ]
+            self.unique_by_file.update(
+                find_existing_images(
+                    unchecked,
+                    self.db_shards,
+                    method="filename",
+                    snapshot=self.index_snapshot,
+                    reader=self.index_reader,
+                )
+            )
+            # Which dates are fully, partly or not imported, from the summary tables
+            coverage = find_date_coverage(
+                changed, self.db_shards, reader=self.index_reader
+            )
 
-        for date, files in grouped_files.items():
+        for date, files in sorted(changed.items()):
             files_jpg = [
                 filename
                 for filename in files
@@ -129,48 +358,98 @@ class App:
                 for filename in files
                 if any(filename.lower().endswith(ext) for ext in raw_extensions)
             ]
-            pane = ttk.Frame(date_canvas_frame)
-            pane.pack(fill=tk.X, padx=5, pady=2)
+            # Show the JPEG of each shot where there is one, otherwise the
+            # preview embedded in the RAW file
+            jpg_stems = {os.path.splitext(filename)[0] for filename in files_jpg}
+            files_display = files_jpg + [
+                filename
+                for filename in files_raw
+                if os.path.splitext(filename)[0] not in jpg_stems
+            ]
 
-            header_frame = ttk.Frame(pane)
-            header_frame.pack(fill=tk.X)
+            entry = self.date_panes.get(date)
+            if entry is None:
+                entry = self.add_date_pane(date)
+            elif entry["display"] != files_display and len(entry["pane"].winfo_children()) > 1:
+                # Open, so show the new files too
+                for widget in entry["pane"].winfo_children()[1:]:
+                    widget.destroy()
+                display_images(
+                    date, files_display, entry["pane"], self.get_thumbnail_loader()
+                )
+            entry.update(files=files, display=files_display, raw=files_raw)
 
             # Calc unique RAW files
             if self.db_path is not None:
-                matches = find_existing_images(files, self.db_path, method="filename")
-                existing_count = len([x[0] for x in matches if x[1] == False])
+                existing_count = len(
+                    [file for file in files if self.unique_by_file.get(file) == False]
+                )
             else:
-                matches = None
                 existing_count = "N/A"
 
-            header = ttk.Label(
-                header_frame,
-                text=f"{date} ({len(files_jpg)} files {existing_count} Existing)",
-            )
-            header.pack(side=tk.LEFT, padx=5, pady=2)
-
-            toggle_button = ttk.Button(header_frame, text="Show", width=6)
-            toggle_button.pack(side=tk.RIGHT, padx=5)
-            toggle_button.bind(
-                "<Button-1>",
-                lambda event, date=date, files=files_jpg, pane=pane, button=toggle_button: toggle_pane(
-                    date, files, pane, button
-                ),
-            )
+            text = f"{date} ({len(files_display)} files {existing_count} Existing)"
+            if self.db_path is not None and date in coverage:
+                imported, total, folders = coverage[date]
+                text += f" - {coverage_status(imported, total)}"
+                if folders:
+                    text += f" in {', '.join(folders)}"
+            entry["header"].config(text=text)
+
+    def add_date_pane(self, date):
+        """Add an empty pane for date among the panes shown, in date order, and return its entry in date_panes."""
+        pane = ttk.Frame(date_canvas_frame)
+        later = [other for other in self.date_panes if other > date]
+        if later:
+            pane.pack(fill=tk.X, padx=5, pady=2, before=self.date_panes[min(later)]["pane"])
+        else:
+            pane.pack(fill=tk.X, padx=5, pady=2)
 
-            upload_button = ttk.Button(header_frame, text="Upload", width=6)
-            upload_button.pack(side=tk.RIGHT, padx=5)
-            upload_button.bind(
-                "<Button-1>",
-                lambda event, date=date, files=files_raw: self.open_import_window(
-                    date, files
-                ),
-            )
+        header_frame = ttk.Frame(pane)
+        header_frame.pack(fill=tk.X)
+
+        header = ttk.Label(header_frame)
+        header.pack(side=tk.LEFT, padx=5, pady=2)
+
+        # The buttons look up the date's files when clicked, as they change
+        # while the card is scanned
+        toggle_button = ttk.Button(header_frame, text="Show", width=6)
+        toggle_button.pack(side=tk.RIGHT, padx=5)
+        toggle_button.bind(
+            "<Button-1>",
+            lambda event: toggle_pane(
+                date,
+                self.date_panes[date]["display"],
+                pane,
+                toggle_button,
+                self.get_thumbnail_loader(),
+            ),
+        )
+
+        upload_button = ttk.Button(header_frame, text="Upload", width=6)
+        upload_button.pack(side=tk.RIGHT, padx=5)
+        upload_button.bind(
+            "<Button-1>",
+            lambda event: self.open_import_window(date, self.date_panes[date]["raw"]),
+        )
+
+        entry = {"pane": pane, "header": header, "files": None, "display": None, "raw": None}
+        self.date_panes[date] = entry
+        return entry
 
-    def __init__(self, root):
+    def __init__(self, root, databases=()):
         self.root = root
         self.root.title("Folder Selector")
         self.root.geometry("1200x800")
+        # Created on first use, see get_thumbnail_loader and scan_card
+        self.thumbnail_loader = None
+        self.metadata_cache = None
+        self.card_cache = None
+        self.scan_id = 0
+        self.card_contents = {}
+        self.card_listing = {}
+        self.unique_by_file = {}
+        # {date: {"pane", "header", "files", "display", "raw"}} of the dates shown
+        self.date_panes = {}
 
         input_frame = tk.Frame(root)
         input_frame.pack(pady=10, padx=10)
@@ -180,15 +459,16 @@ class App:
         )
         self.select_button.grid(row=0, column=0, padx=10)
 
-        self.db_path = (
-            "/Users/benshaughnessy/Dropbox/Photographs/photo_db_real.db.sqlite"
-        )
+        self.db_shards = list(databases)
+        self.db_path = self.db_shards[0] if self.db_shards else None
+        self.index_reader = None
+        self.index_snapshot = None
         self.db_button = tk.Button(
             input_frame, text="Select Database", command=self.select_database
         )
         self.db_button.grid(row=0, column=1, padx=10)
 
-        self.db_info_label = tk.Label(input_frame, text=f"DB Path: {self.db_path}")
+        self.db_info_label = tk.Label(input_frame, text=self.db_label())
         self.db_info_label.grid(row=0, column=3, padx=10)
 
         global date_frame, date_canvas_frame
@@ -213,16 +493,46 @@ class App:
             lambda e: date_canvas.configure(scrollregion=date_canvas.bbox("all")),
         )
 
+        # Open the index once the window has been drawn
+        self.root.after_idle(self.open_index)
+
     def open_import_window(self, collection_date, files_to_import):
+        from app_import_window import ImportWindow
+
         ImportWindow(
             self.root,
             "/Users/benshaughnessy/Dropbox/Photographs/",
             collection_date,
             files_to_import,
+            thumbnail_loader=self.get_thumbnail_loader(),
+            database=self.db_path,
         )
 
 
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = App(root)
-    root.mainloop()
+    parser = argparse.ArgumentParser(description="Browse a card and import new photos.")
+    parser.add_argument(
+        "--stats",
+        type=str,
+        default=None,
+        help="Write per-stage timings, cache hits and the slowest files to this JSON file on exit.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Write a cProfile dump of the Tk thread to this file on exit.",
+    )
+    parser.add_argument(
+        "--database",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Index databases (shards) to check cards against (default: the ones selected last time).",
+    )
+    args = parser.parse_args()
+
+    with profiled(args.stats, args.profile):
+        root = tk.Tk()
+        app = App(root, args.database if args.database else load_databases())
+        root.mainloop()
@@ -1,15 +1,27 @@
 import tkinter as tk
 from tkinter import filedialog, ttk
 from tkinter import messagebox
-from PIL import Image, ImageTk
 import os
 import datetime
-import shutil
+import threading
+from importer import ImportJob
+from thumbnails import ThumbnailLoader
+from thumbnail_grid import ThumbnailGrid
 
 
 class ImportWindow:
-    def __init__(self, parent, parent_dir, collection_date: datetime.date, file_paths):
+    def __init__(
+        self,
+        parent,
+        parent_dir,
+        collection_date: datetime.date,
+        file_paths,
+        thumbnail_loader=None,
+        database=None,
+    ):
         self.root = parent
+        self.database = database
+        self.thumbnail_loader = thumbnail_loader or ThumbnailLoader(parent)
         # self.root.title("Import Files")
         # self.root.geometry("1200x1200")
         self.window = tk.Toplevel(self.root)
@@ -45,6 +57,11 @@ class ImportWindow:
         )
         self.upload_button.grid(row=0, column=2, padx=10)
 
+        self.progress_bar = ttk.Progressbar(self.parent, length=200)
+        self.progress_bar.grid(row=0, column=3, padx=10)
+        self.progress_label = tk.Label(self.parent, text="")
+        self.progress_label.grid(row=0, column=4, padx=10)
+
         self.image_frame = ttk.Frame(self.window)
         self.image_frame.pack(fill=tk.BOTH, expand=True)
 
@@ -55,53 +72,22 @@ class ImportWindow:
             pass
 
     def display_images(self):
-        canvas = tk.Canvas(self.image_frame)
-        canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-
-        scrollbar = ttk.Scrollbar(
-            self.image_frame, orient=tk.VERTICAL, command=canvas.yview
+        grid = ThumbnailGrid(
+            self.image_frame,
+            self.file_paths,
+            self.thumbnail_loader,
+            size=(300, 300),
+            columns=3,
+            on_click=self.toggle_selection,
+            selected=self.selected_files,
         )
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-
-        canvas.configure(yscrollcommand=scrollbar.set)
-
-        inner_frame = ttk.Frame(canvas)
-        canvas.create_window((0, 0), window=inner_frame, anchor="nw")
+        grid.pack(fill=tk.BOTH, expand=True)
 
-        row, col = 0, 0
-        for file_path in self.file_paths:
-            frame = tk.Frame(inner_frame, bd=0, relief=tk.FLAT)
-            frame.grid(row=row, column=col, padx=10, pady=10)
-
-            img = Image.open(file_path)
-            img.thumbnail((300, 300))
-            img = ImageTk.PhotoImage(img)
-
-            label = tk.Label(frame, image=img)
-            label.image = img
-            label.pack()
-            label.bind(
-                "<Button-1>",
-                lambda e, file_path=file_path, frame=frame: self.toggle_selection(
-                    file_path, frame
-                ),
-            )
-
-            col += 1
-            if col == 3:
-                col = 0
-                row += 1
-
-        inner_frame.update_idletasks()
-        canvas.configure(scrollregion=canvas.bbox("all"))
-
-    def toggle_selection(self, file_path, frame):
+    def toggle_selection(self, file_path):
         if file_path in self.selected_files:
             self.selected_files.remove(file_path)
-            frame.config(relief=tk.FLAT, bd=0)
         else:
             self.selected_files.add(file_path)
-            frame.config(relief=tk.FLAT, bd=2, bg="white")
 
     def upload_files(self):
         destination_folder = self.folder_entry.get()
@@ -117,29 +103,40 @@ class ImportWindow:
                 )
 
                 if result:
-                    # Ensure that the destination folder exists, create it if it doesn't
-                    os.makedirs(full_folder_path, exist_ok=True)
-                    for file in files_to_import:
-
-                        destination_file = os.path.join(
-                            full_folder_path, os.path.basename(file)
-                        )
-
-                        if os.path.exists(destination_file):
-                            print(
-                                f"Warning: File {destination_file} already exists in destination folder."
-                            )
-                            # You can choose to handle this case as you wish, for example, skip the copying
-                        else:
-                            # Copy the file to the destination folder
-                            print(f"Copying {file}")
-                            shutil.copy(file, full_folder_path)
-                    print("Done")
+                    self.start_import(files_to_import, full_folder_path)
             else:
                 print("Must select some files")
         else:
             print("No destination folder specified")
 
+    def start_import(self, files_to_import, full_folder_path):
+        job = ImportJob(files_to_import, full_folder_path, database=self.database)
+        self.upload_button.config(state=tk.DISABLED)
+        threading.Thread(target=job.run, daemon=True).start()
+        self.show_import_progress(job)
+
+    def show_import_progress(self, job):
+        if not self.window.winfo_exists():
+            return
+        files_done, total_files, bytes_done, total_bytes, rate = job.progress()
+        self.progress_bar.config(maximum=max(total_bytes, 1), value=bytes_done)
+        self.progress_label.config(
+            text=f"{files_done}/{total_files} files, {rate / 1024 / 1024:.1f} MB/s"
+        )
+        if not job.finished:
+            self.window.after(200, self.show_import_progress, job)
+            return
+
+        self.progress_label.config(
+            text=f"Copied {len(job.copied)}, already done {len(job.resumed)}, "
+            f"skipped {len(job.skipped)}, failed {len(job.failed)}, "
+            f"already indexed {len(job.already_indexed)}"
+        )
+        self.upload_button.config(state=tk.NORMAL)
+        if job.error is not None:
+            messagebox.showerror("Import failed", str(job.error), parent=self.window)
+        print("Done")
+
 
 if __name__ == "__main__":
     files_to_import = [
@@ -0,0 +1,412 @@
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import struct
+import sys
+import time
+from datetime import datetime, timedelta
+from utils import (
+    HASH_ALGORITHMS,
+    IndexSnapshot,
+    compute_hash,
+    create_photo_index_table,
+    find_date_coverage,
+    find_existing_images,
+    find_similar_images,
+    group_by_date,
+    refresh_summaries,
+    to_perceptual_column,
+    write_batch_to_db,
+)
+
+# Shared filler for synthetic files; each file also gets unique bytes at both
+# ends so fingerprints and hashes differ
+FILLER = os.urandom(1024 * 1024)
+UNIQUE_BYTES = 64 * 1024
+
+
+def make_preview_jpeg(size=(1620, 1080)):
+    """Return the bytes of a noisy JPEG like a camera's embedded preview, or None without PIL."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    img = Image.effect_noise(size, 64).convert("RGB")
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def write_raw_file(file_path, file_size, preview):
+    """Write a little-endian TIFF with one IFD pointing at preview, padded to file_size.
+
+    That is the layout raw_preview reads from CR2/NEF/ARW files, so the
+    thumbnail path does the same work as on a real card.
+    """
+    preview = preview or b""
+    ifd_offset = 8
+    entries = [
+        (0x00FE, 4, 1, 1),  # NewSubFileType: reduced resolution image
+        (0x0201, 4, 1, 0),  # JPEG offset, filled in below
+        (0x0202, 4, 1, len(preview)),
+    ]
+    preview_offset = ifd_offset + 2 + 12 * len(entries) + 4 + UNIQUE_BYTES
+    entries[1] = (0x0201, 4, 1, preview_offset)
+
+    header = b"II" + struct.pack("<HI", 42, ifd_offset)
+    ifd = struct.pack("<H", len(entries))
+    for tag, value_type, count, value in entries:
+        ifd += struct.pack("<HHII", tag, value_type, count, value)
+    ifd += struct.pack("<I", 0)
+
+    with open(file_path, "wb") as f:
+        f.write(header + ifd + os.urandom(UNIQUE_BYTES) + preview)
+        remaining = file_size - f.tell() - UNIQUE_BYTES
+        while remaining > 0:
+            chunk = FILLER[: min(remaining, len(FILLER))]
+            f.write(chunk)
+            remaining -= len(chunk)
+        f.write(os.urandom(UNIQUE_BYTES))
+
+
+def make_tree(directory, folders=10, files_per_folder=50, file_size=25 * 1024 * 1024, jpegs=True):
+    """Create a library-like tree of synthetic RAW files (and JPEG sidecars) under directory.
+
+    Returns the list of RAW file paths. Each folder is a day, and mtimes are
+    set to that day so the files group like a real card.
+    """
+    preview = make_preview_jpeg()
+    raw_files = []
+    start = datetime(2024, 1, 1, 9)
+    for folder_number in range(folders):
+        day = start + timedelta(days=folder_number)
+        folder = os.path.join(directory, f"{day:%Y-%m-%d} Shoot {folder_number}")
+        os.makedirs(folder, exist_ok=True)
+        for file_number in range(files_per_folder):
+            name = f"IMG_{folder_number * files_per_folder + file_number:05d}"
+            taken = (day + timedelta(seconds=file_number)).timestamp()
+            raw_path = os.path.join(folder, name + ".CR2")
+            write_raw_file(raw_path, file_size, preview)
+            os.utime(raw_path, (taken, taken))
+            raw_files.append(raw_path)
+            if jpegs and preview is not None:
+                jpeg_path = os.path.join(folder, name + ".JPG")
+                with open(jpeg_path, "wb") as f:
+                    f.write(preview)
+                os.utime(jpeg_path, (taken, taken))
+    return raw_files
+
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else None
+
+
+def bench_hash(file_path):
+    """Return {algorithm: MB/s} for hashing one file with each of HASH_ALGORITHMS."""
+    megabytes = os.path.getsize(file_path) / 1024 / 1024
+    results = {}
+    for algorithm in sorted(HASH_ALGORITHMS):
+        started = time.perf_counter()
+        compute_hash(file_path, algorithm)
+        results[algorithm] = rate(megabytes, time.perf_counter() - started)
+    return results
+
+
+def bench_index(directory, database, raw_files, workers):
+    """Time a full index of directory and an incremental re-run with nothing changed.
+
+    workers=0 leaves the hashing concurrency to the IOScheduler's device profile.
+    """
+    from main import index_photos
+
+    megabytes = sum(os.path.getsize(file) for file in raw_files) / 1024 / 1024
+    if os.path.exists(database):
+        os.remove(database)
+
+    started = time.perf_counter()
+    index_photos(directory, database, False, workers=workers or None)
+    full = time.perf_counter() - started
+
+    started = time.perf_counter()
+    index_photos(directory, database, False, incremental=True, workers=workers or None)
+    incremental = time.perf_counter() - started
+    return {
+        "files": len(raw_files),
+        "megabytes": megabytes,
+        "workers": workers or "per device",
+        "seconds": full,
+        "files_per_second": rate(len(raw_files), full),
+        "mb_per_second": rate(megabytes, full),
+        "incremental_seconds": incremental,
+        "incremental_files_per_second": rate(len(raw_files), incremental),
+    }
+
+
+def synthetic_perceptual_hash(number):
+    # Spreads the bits of number over 64 bits, like real hashes
+    return to_perceptual_column((number * 0x9E3779B97F4A7C15) & ((1 << 64) - 1))
+
+
+def make_index(database, rows):
+    """Fill a new photo_index with `rows` synthetic rows, without any files behind them."""
+    if os.path.exists(database):
+        os.remove(database)
+    conn = sqlite3.connect(database)
+    cursor = conn.cursor()
+    create_photo_index_table(cursor)
+    for start in range(0, rows, 100000):
+        write_batch_to_db(
+            cursor,
+            [
+                (
+                    f"/library/{number // 500:05d}/IMG_{number:07d}.CR2",
+                    f"{number // 500:05d}",
+                    f"IMG_{number:07d}.CR2",
+                    f"{number:064x}",
+                    "blake2b",
+                    synthetic_capture_time(number).isoformat(),
+                    25 * 1024 * 1024 + number,
+                    0,
+                    f"{25 * 1024 * 1024 + number}:{number:032x}",
+                    synthetic_perceptual_hash(number),
+                    synthetic_capture_time(number).isoformat(),
+                )
+                for number in range(start, min(start + 100000, rows))
+            ],
+            roots={},
+        )
+    refresh_summaries(cursor)
+    conn.commit()
+    conn.close()
+
+
+def synthetic_capture_time(number):
+    """Capture time of synthetic row `number`: each folder of 500 rows is one day's shoot."""
+    return datetime(2010, 1, 1, 9) + timedelta(days=number // 500, seconds=number % 500)
+
+
+def bench_lookup(database, rows, card_files=5000):
+    """Return filename lookup latency for a card of card_files against an index of `rows` rows.
+
+    Half of the card is already in the index. Both the batched SQLite query
+    and an IndexSnapshot are timed, the latter cold (including its load) and warm.
+    Near-duplicate searches are timed for 100 hashes a few bits off indexed ones,
+    and date coverage of the card from the summary tables.
+    """
+    started = time.perf_counter()
+    make_index(database, rows)
+    build = time.perf_counter() - started
+    card = [
+        f"/card/DCIM/100CANON/IMG_{number:07d}.CR2"
+        for number in range(rows - card_files // 2, rows + card_files - card_files // 2)
+    ]
+
+    started = time.perf_counter()
+    find_existing_images(card, database, method="filename")
+    query = time.perf_counter() - started
+
+    snapshot = IndexSnapshot(database)
+    started = time.perf_counter()
+    snapshot.refresh()
+    snapshot_load = time.perf_counter() - started
+
+    started = time.perf_counter()
+    find_existing_images(card, database, method="filename", snapshot=snapshot)
+    snapshot_lookup = time.perf_counter() - started
+
+    conn = sqlite3.connect(database)
+    cursor = conn.cursor()
+    started = time.perf_counter()
+    for number in range(0, rows, max(1, rows // 100)):
+        find_similar_images(cursor, synthetic_perceptual_hash(number) ^ 0b1011)
+    perceptual = (time.perf_counter() - started) / min(rows, 100)
+    conn.close()
+
+    card_dates = group_by_date(
+        {
+            file: synthetic_capture_time(number)
+            for number, file in enumerate(card, rows - card_files // 2)
+        }
+    )
+    started = time.perf_counter()
+    find_date_coverage(card_dates, database)
+    coverage = time.perf_counter() - started
+    return {
+        "rows": rows,
+        "card_files": card_files,
+        "build_seconds": build,
+        "query_ms": query * 1000,
+        "snapshot_load_ms": snapshot_load * 1000,
+        "snapshot_lookup_ms": snapshot_lookup * 1000,
+        "perceptual_lookup_ms": perceptual * 1000,
+        "coverage_lookup_ms": coverage * 1000,
+    }
+
+
+def bench_content_lookup(database, raw_files):
+    """Time a hash lookup of the indexed files, which are all found."""
+    started = time.perf_counter()
+    find_existing_images(raw_files, database, method="hash")
+    seconds = time.perf_counter() - started
+    return {
+        "files": len(raw_files),
+        "seconds": seconds,
+        "files_per_second": rate(len(raw_files), seconds),
+    }
+
+
+def bench_thumbnails(files, cache_dir, size=(300, 300)):
+    """Time thumbnails of files with an empty cache, then again from the cache."""
+    try:
+        from thumbnails import ThumbnailCache
+    except ImportError as e:
+        return {"skipped": str(e)}
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    cache = ThumbnailCache(cache_dir=cache_dir)
+    results = {"files": len(files), "size": list(size)}
+    for run in ("cold", "warm"):
+        started = time.perf_counter()
+        for file_path in files:
+            cache.get(file_path, size)
+        seconds = time.perf_counter() - started
+        results[f"{run}_ms_per_file"] = seconds * 1000 / len(files) if files else None
+    return results
+
+
+def bench_copy(raw_files, destination, database):
+    """Time an ImportJob copying raw_files into destination and indexing them."""
+    from importer import ImportJob
+
+    shutil.rmtree(destination, ignore_errors=True)
+    if os.path.exists(database):
+        os.remove(database)
+    job = ImportJob(raw_files, destination, database=database)
+    started = time.perf_counter()
+    job.run()
+    seconds = time.perf_counter() - started
+    if job.error is not None:
+        raise job.error
+    return {
+        "files": len(job.copied),
+        "failed": len(job.failed),
+        "seconds": seconds,
+        "mb_per_second": rate(job.total_bytes / 1024 / 1024, seconds),
+        "workers": job.workers,
+    }
+
+
+def run_benchmarks(args):
+    os.makedirs(args.workdir, exist_ok=True)
+    library = os.path.join(args.workdir, "library")
+    results = {
+        "started": datetime.now().isoformat(),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "config": {
+            "folders": args.folders,
+            "files_per_folder": args.files_per_folder,
+            "file_size_mb": args.file_size_mb,
+            "workers": args.workers,
+            "rows": args.rows,
+        },
+    }
+
+    print(f"Creating {args.folders * args.files_per_folder} files in {library}", file=sys.stderr)
+    shutil.rmtree(library, ignore_errors=True)
+    raw_files = make_tree(
+        library,
+        args.folders,
+        args.files_per_folder,
+        int(args.file_size_mb * 1024 * 1024),
+    )
+    # Files were just written, so reads come from the page cache unless it is dropped
+    results["page_cache"] = "warm"
+
+    if "hash" in args.only:
+        results["hash_mb_per_second"] = bench_hash(raw_files[0])
+    if "index" in args.only:
+        index_db = os.path.join(args.workdir, "index.sqlite")
+        results["index"] = [
+            bench_index(library, index_db, raw_files, workers) for workers in args.workers
+        ]
+        results["content_lookup"] = bench_content_lookup(index_db, raw_files)
+    if "lookup" in args.only:
+        lookup_db = os.path.join(args.workdir, "lookup.sqlite")
+        results["lookup"] = [bench_lookup(lookup_db, rows) for rows in args.rows]
+    if "thumbnails" in args.only:
+        jpegs = [os.path.splitext(file)[0] + ".JPG" for file in raw_files]
+        cache_dir = os.path.join(args.workdir, "thumbnails")
+        results["thumbnails"] = {
+            "raw": bench_thumbnails(raw_files, cache_dir),
+            "jpeg": bench_thumbnails([f for f in jpegs if os.path.exists(f)], cache_dir),
+        }
+    if "copy" in args.only:
+        results["copy"] = bench_copy(
+            raw_files,
+            os.path.join(args.workdir, "imported"),
+            os.path.join(args.workdir, "import.sqlite"),
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark indexing, lookups, thumbnails and copying on a synthetic library."
+    )
+    parser.add_argument(
+        "--workdir",
+        type=str,
+        default="benchmark_data",
+        help="Directory for the synthetic library and databases.",
+    )
+    parser.add_argument("--folders", type=int, default=10, help="Folders in the library.")
+    parser.add_argument(
+        "--files-per-folder", type=int, default=20, help="RAW files per folder."
+    )
+    parser.add_argument(
+        "--file-size-mb", type=float, default=25, help="Size of each RAW file in MB."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 4, 0],
+        help="Hashing worker counts to index with (0 for the per-device default).",
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+        help="photo_index sizes to time lookups against.",
+    )
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=["hash", "index", "lookup", "thumbnails", "copy"],
+        default=["hash", "index", "lookup", "thumbnails", "copy"],
+        help="Benchmarks to run.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Write the results as JSON to this file (default: stdout).",
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(results, indent=2))
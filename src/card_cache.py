@@ -0,0 +1,188 @@
+import ctypes
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+from datetime import datetime
+from exif import get_capture_times
+from utils import CACHE_DIR, walk_files_parallel
+
+DEFAULT_CARD_DB = os.path.join(CACHE_DIR, "cards.sqlite")
+
+
+def mount_point(path):
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def volume_id(path):
+    """Return an ID for the volume holding path that survives ejecting and re-inserting it.
+
+    That is the volume serial number on Windows and the filesystem UUID on
+    Linux. Elsewhere the mount point is used, which for a card on macOS is
+    its label (/Volumes/EOS_DIGITAL).
+    """
+    mount = mount_point(path)
+    if sys.platform == "win32":
+        serial = ctypes.c_uint32()
+        if ctypes.windll.kernel32.GetVolumeInformationW(
+            ctypes.c_wchar_p(mount), None, 0, ctypes.byref(serial), None, None, None, 0
+        ):
+            return f"serial:{serial.value:08X}"
+    elif os.path.isdir("/dev/disk/by-uuid"):
+        device = os.stat(mount).st_dev
+        for name in os.listdir("/dev/disk/by-uuid"):
+            try:
+                if os.stat(os.path.join("/dev/disk/by-uuid", name)).st_rdev == device:
+                    return f"uuid:{name}"
+            except OSError:
+                continue
+    return f"mount:{mount}"
+
+
+def card_key(folder_path):
+    """Return the key a card folder is cached under: its volume ID and its path within the volume."""
+    relative = os.path.relpath(os.path.abspath(folder_path), mount_point(folder_path))
+    return f"{volume_id(folder_path)}|{relative.replace(os.sep, '/')}"
+
+
+def listing_digest(listing):
+    """Return a digest of {relative_path: (file_size, mtime)}, equal for two scans of an unchanged card."""
+    digest = hashlib.blake2b(digest_size=16)
+    for relative_path, (file_size, mtime) in sorted(listing.items()):
+        digest.update(f"{relative_path}\0{file_size}\0{mtime!r}\n".encode())
+    return digest.hexdigest()
+
+
+class CardCache:
+    """Results of the last scan of each card: its listing, capture times and index check results.
+
+    Reopening a card can show the cached dates straight away, and the scan
+    that follows only reads files whose size or mtime differ from the cached
+    listing. Index check results are only reused if the index database hasn't
+    changed since they were cached. Thumbnails need no entry here, as the
+    ThumbnailCache already keeps them by path, size and mtime.
+    """
+
+    def __init__(self, database=DEFAULT_CARD_DB):
+        os.makedirs(os.path.dirname(database), exist_ok=True)
+        self.conn = sqlite3.connect(database)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cards (
+                card_key TEXT PRIMARY KEY,
+                digest TEXT,
+                index_signature TEXT,
+                scanned TEXT
+            )
+        """
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS card_files (
+                card_key TEXT,
+                relative_path TEXT,
+                file_size INTEGER,
+                mtime REAL,
+                capture_time TEXT,
+                is_unique INTEGER,
+                PRIMARY KEY (card_key, relative_path)
+            )
+        """
+        )
+        self.conn.commit()
+
+    def load(self, key):
+        """Return (digest, index_signature, {relative_path: (file_size, mtime, capture_time, is_unique)}), or None."""
+        card = self.conn.execute(
+            "SELECT digest, index_signature FROM cards WHERE card_key = ?", (key,)
+        ).fetchone()
+        if card is None:
+            return None
+        files = {}
+        for relative_path, file_size, mtime, capture_time, is_unique in self.conn.execute(
+            """
+            SELECT relative_path, file_size, mtime, capture_time, is_unique
+            FROM card_files WHERE card_key = ?
+        """,
+            (key,),
+        ):
+            files[relative_path] = (
+                file_size,
+                mtime,
+                datetime.fromisoformat(capture_time),
+                None if is_unique is None else bool(is_unique),
+            )
+        return card[0], card[1], files
+
+    def save(self, key, listing, capture_times, unique_by_file, index_signature):
+        """Replace the cached scan of a card.
+
+        listing is {relative_path: (file_size, mtime)}, and capture_times and
+        unique_by_file are keyed by the same relative paths.
+        """
+        self.conn.execute("DELETE FROM card_files WHERE card_key = ?", (key,))
+        self.conn.executemany(
+            "INSERT INTO card_files VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    key,
+                    relative_path,
+                    file_size,
+                    mtime,
+                    capture_times[relative_path].isoformat(),
+                    unique_by_file.get(relative_path),
+                )
+                for relative_path, (file_size, mtime) in listing.items()
+                if relative_path in capture_times
+            ],
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cards VALUES (?, ?, ?, ?)",
+            (key, listing_digest(listing), index_signature, datetime.now().isoformat()),
+        )
+        self.conn.commit()
+
+
+def index_signature(snapshot):
+    """Return a string that changes whenever an IndexSnapshot is loaded from changed databases, or None.
+
+    Index check results are only as current as the snapshot that answered
+    them, which can lag the databases while it reloads in the background.
+    """
+    if snapshot is None or snapshot.signature is None:
+        return None
+    return json.dumps(snapshot.signature)
+
+
+def iter_card_capture_times(folder_path, cached_files, metadata_cache=None, executor=None):
+    """Yield ({file_path: capture time}, {relative_path: (file_size, mtime)}) for each folder of a card.
+
+    Files whose size and mtime match cached_files (from CardCache.load) take
+    their capture time from it, so only new or changed files are read.
+    """
+    if not os.path.isdir(folder_path):
+        print("Directory not found.")
+        return
+    for files, _ in walk_files_parallel(folder_path, set()):
+        contents = {}
+        changed = {}
+        listing = {}
+        for file_path, stat in files:
+            relative_path = os.path.relpath(file_path, folder_path).replace(os.sep, "/")
+            listing[relative_path] = (stat.st_size, stat.st_mtime)
+            cached = cached_files.get(relative_path)
+            if cached is not None and cached[:2] == listing[relative_path]:
+                contents[file_path] = cached[2]
+            else:
+                changed[file_path] = datetime.fromtimestamp(stat.st_mtime)
+        if changed:
+            contents.update(get_capture_times(changed, metadata_cache, executor))
+        if files:
+            yield contents, listing
@@ -0,0 +1,207 @@
+import io
+import os
+import re
+import sqlite3
+import struct
+from datetime import datetime
+from raw_preview import numeric_tag, read_ifd, RAF_MAGIC, TIFF_MAGIC
+from utils import CACHE_DIR, chunked
+from profiling import stats as profiling_stats
+
+DEFAULT_METADATA_DB = os.path.join(CACHE_DIR, "metadata.sqlite")
+
+# Bytes of a JPEG searched for its EXIF segment, which comes first in camera files
+JPEG_HEADER_BYTES = 128 * 1024
+
+EXIF_IFD = 0x8769
+DATE_TIME = 0x0132
+DATE_TIME_ORIGINAL = 0x9003
+SUB_SEC_TIME_ORIGINAL = 0x9291
+IMAGE_NUMBER = 0x9211
+BODY_SERIAL_NUMBER = 0xA431
+
+
+def parse_tiff_metadata(f):
+    """Return (tags from IFD0 and the EXIF IFD merged, or None) for a TIFF stream at offset 0 of f."""
+    header = f.read(8)
+    endian = {b"II": "<", b"MM": ">"}.get(header[:2])
+    if endian is None or len(header) < 8:
+        return None
+    magic, first_ifd = struct.unpack(endian + "HI", header[2:])
+    if magic not in TIFF_MAGIC:
+        return None
+    tags, _ = read_ifd(f, first_ifd, endian)
+    if numeric_tag(tags, EXIF_IFD):
+        exif_tags, _ = read_ifd(f, tags[EXIF_IFD][0], endian)
+        tags.update(exif_tags)
+    return tags
+
+
+def parse_jpeg_metadata(data):
+    """Return the EXIF tags of JPEG bytes, or None if there is no EXIF segment in them."""
+    if data[:2] != b"\xff\xd8":
+        return None
+    position = 2
+    while position + 4 <= len(data) and data[position] == 0xFF:
+        marker = data[position + 1]
+        (length,) = struct.unpack(">H", data[position + 2 : position + 4])
+        segment = data[position + 4 : position + 2 + length]
+        if marker == 0xE1 and segment.startswith(b"Exif\0\0"):
+            return parse_tiff_metadata(io.BytesIO(segment[6:]))
+        if marker == 0xDA:  # Start of scan, no more headers
+            break
+        position += 2 + length
+    return None
+
+
+def read_capture_metadata(file_path):
+    """Return (capture_time, camera_serial, sequence_number) read from the header bytes of a photo.
+
+    Understands JPEGs, TIFF-based RAW files and RAF files (through their
+    embedded JPEG). capture_time is None when no EXIF date is found.
+    sequence_number falls back to the digits in the filename (IMG_1951.CR2).
+    """
+    tags = None
+    try:
+        with profiling_stats.stage("exif_read", file_path), open(file_path, "rb") as f:
+            header = f.read(92)
+            f.seek(0)
+            if header.startswith(RAF_MAGIC) and len(header) == 92:
+                (offset,) = struct.unpack(">I", header[84:88])
+                f.seek(offset)
+                tags = parse_jpeg_metadata(f.read(JPEG_HEADER_BYTES))
+            elif header[:2] == b"\xff\xd8":
+                tags = parse_jpeg_metadata(f.read(JPEG_HEADER_BYTES))
+            else:
+                tags = parse_tiff_metadata(f)
+    except (OSError, struct.error, ValueError):
+        tags = None
+    tags = tags or {}
+
+    capture_time = None
+    date_string = tags.get(DATE_TIME_ORIGINAL, tags.get(DATE_TIME, [None]))[0]
+    if isinstance(date_string, str):
+        try:
+            capture_time = datetime.strptime(date_string.strip(), "%Y:%m:%d %H:%M:%S")
+        except ValueError:
+            pass
+    sub_seconds = tags.get(SUB_SEC_TIME_ORIGINAL, [""])[0]
+    if capture_time is not None and isinstance(sub_seconds, str) and sub_seconds.isdigit():
+        capture_time = capture_time.replace(
+            microsecond=int(sub_seconds[:6].ljust(6, "0"))
+        )
+
+    camera_serial = tags.get(BODY_SERIAL_NUMBER, [None])[0]
+    sequence_number = tags.get(IMAGE_NUMBER, [None])[0]
+    if sequence_number is None:
+        digits = re.findall(r"\d+", os.path.splitext(os.path.basename(file_path))[0])
+        sequence_number = int(digits[-1]) if digits else None
+    return capture_time, camera_serial, sequence_number
+
+
+def read_capture_time(file_path, stat):
+    """Return the EXIF capture time of a file as stored in photo_index, falling back to its mtime.
+
+    Only the file's headers are read. Storing the mtime when there is no EXIF
+    date means incremental runs don't read the file again looking for one.
+    """
+    capture_time = read_capture_metadata(file_path)[0]
+    if capture_time is None:
+        capture_time = datetime.fromtimestamp(stat.st_mtime)
+    return capture_time.isoformat()
+
+
+class MetadataCache:
+    """Capture metadata of card files, cached in SQLite by path, size and mtime.
+
+    Files that haven't changed since they were last read cost a single
+    indexed lookup, so regrouping a card reads no file contents.
+    """
+
+    def __init__(self, database=DEFAULT_METADATA_DB):
+        os.makedirs(os.path.dirname(database), exist_ok=True)
+        # Used from the card scanning thread, one thread at a time
+        self.conn = sqlite3.connect(database, check_same_thread=False)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS file_metadata (
+                filepath TEXT PRIMARY KEY,
+                file_size INTEGER,
+                mtime REAL,
+                capture_time TEXT,
+                camera_serial TEXT,
+                sequence_number INTEGER
+            )
+        """
+        )
+        self.conn.commit()
+
+    def get_many(self, stats, executor=None):
+        """Return {file_path: (capture_time, camera_serial, sequence_number)} for {file_path: os.stat_result}.
+
+        Files missing from the cache are read on executor if one is given.
+        """
+        metadata = {}
+        for chunk in chunked(stats):
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"""
+                SELECT filepath, file_size, mtime, capture_time, camera_serial, sequence_number
+                FROM file_metadata WHERE filepath IN ({placeholders})
+            """,
+                chunk,
+            )
+            for file_path, file_size, mtime, capture_time, serial, sequence in rows:
+                stat = stats[file_path]
+                if (file_size, mtime) == (stat.st_size, stat.st_mtime):
+                    if capture_time is not None:
+                        capture_time = datetime.fromisoformat(capture_time)
+                    metadata[file_path] = (capture_time, serial, sequence)
+
+        missing = [file_path for file_path in stats if file_path not in metadata]
+        profiling_stats.count("metadata_cache_hits", len(metadata))
+        profiling_stats.count("metadata_cache_misses", len(missing))
+        read = executor.map if executor is not None else map
+        metadata.update(zip(missing, read(read_capture_metadata, missing)))
+        self.put_many({file_path: stats[file_path] for file_path in missing}, metadata)
+        return metadata
+
+    def put_many(self, stats, metadata):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO file_metadata VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    file_path,
+                    stat.st_size,
+                    stat.st_mtime,
+                    metadata[file_path][0].isoformat()
+                    if metadata[file_path][0] is not None
+                    else None,
+                    metadata[file_path][1],
+                    metadata[file_path][2],
+                )
+                for file_path, stat in stats.items()
+            ],
+        )
+        self.conn.commit()
+
+
+def get_capture_times(contents, cache=None, executor=None):
+    """Replace the mtimes in an import_photo_metadata result with EXIF capture times where available.
+
+    Camera clocks survive copying, so grouping on them keeps shoots together
+    on cards whose files have been copied around.
+    """
+    if cache is None:
+        cache = MetadataCache()
+    stats = {}
+    for file_path in contents:
+        try:
+            stats[file_path] = os.stat(file_path)
+        except OSError:
+            continue
+    metadata = cache.get_many(stats, executor)
+    return {
+        file_path: metadata.get(file_path, (None,))[0] or mtime
+        for file_path, mtime in contents.items()
+    }
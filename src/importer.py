@@ -0,0 +1,373 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import as_completed
+from datetime import datetime
+from utils import (
+    HASH_ALGORITHMS,
+    DEFAULT_HASH_ALGORITHM,
+    CACHE_DIR,
+    raw_extensions,
+    compute_fingerprint,
+    compute_hash,
+    chunked,
+    create_photo_index_table,
+    find_fingerprint_matches,
+    find_same_content,
+    get_hash_algorithm,
+    write_batch_to_db,
+    refresh_summaries,
+)
+from exif import read_capture_time
+from profiling import stats as profiling_stats
+from io_scheduler import IOScheduler, device_read_size, locality_order
+
+# Kept apart from the index databases, whose write lock an index or watch
+# run can hold for a whole IndexWriter.COMMIT_INTERVAL
+DEFAULT_JOURNAL_DB = os.path.join(CACHE_DIR, "imports.sqlite")
+# Seconds to wait for that lock before writing the imported rows fails
+INDEX_BUSY_TIMEOUT = 120
+
+PLANNED = "planned"
+COPYING = "copying"
+VERIFIED = "verified"
+
+
+def copy_and_hash(source, destination, algorithm, on_bytes=None, read_size=None):
+    """Copy source to destination, hashing the bytes as they are copied, and return the hash.
+
+    Data is written to a temp file next to destination, synced, and renamed
+    into place only once it is complete, so an interrupted copy never leaves
+    a partial file under the final name. The source mtime is kept, like
+    shutil.copy2, so the copy groups and indexes like the original. Reads
+    are read_size bytes, by default the size that suits the source's device.
+    """
+    if read_size is None:
+        read_size = device_read_size(source)
+    content_hash = HASH_ALGORITHMS[algorithm]()
+    temp_path = f"{destination}.importing"
+    buffer = bytearray(read_size)
+    view = memoryview(buffer)
+    try:
+        copying = profiling_stats.stage("copy", source)
+        with copying, open(source, "rb", buffering=0) as src, open(temp_path, "wb") as dst:
+            while True:
+                n = src.readinto(buffer)
+                if not n:
+                    break
+                content_hash.update(view[:n])
+                dst.write(view[:n])
+                profiling_stats.count("bytes_copied", n)
+                if on_bytes is not None:
+                    on_bytes(n)
+            dst.flush()
+            os.fsync(dst.fileno())
+        source_stat = os.stat(source)
+        if os.path.getsize(temp_path) != source_stat.st_size:
+            raise OSError(f"Copy of {source} is incomplete")
+        os.utime(temp_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        os.replace(temp_path, destination)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return content_hash.hexdigest()
+
+
+class ImportJournal:
+    """Status of each file an import copies, kept in SQLite so an interrupted import can resume.
+
+    Files go from planned to copying to verified, and a file is only marked
+    verified once its copy has been synced, size checked and renamed into
+    place. Each change is committed straight away, so after a crash or a
+    pulled card the journal says exactly which copies can be trusted.
+    """
+
+    def __init__(self, database=DEFAULT_JOURNAL_DB):
+        if os.path.dirname(database):
+            os.makedirs(os.path.dirname(database), exist_ok=True)
+        # Written from the copy threads, one at a time under self.lock
+        self.conn = sqlite3.connect(database, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS import_journal (
+                destination TEXT PRIMARY KEY,
+                source TEXT,
+                file_size INTEGER,
+                mtime REAL,
+                status TEXT,
+                content_hash TEXT,
+                hash_algorithm TEXT
+            )
+        """
+        )
+        self.conn.commit()
+
+    def get_many(self, destinations):
+        """Return {destination: (source, file_size, mtime, status, content_hash, hash_algorithm)}."""
+        entries = {}
+        for chunk in chunked(list(destinations)):
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"""
+                SELECT destination, source, file_size, mtime, status, content_hash, hash_algorithm
+                FROM import_journal WHERE destination IN ({placeholders})
+            """,
+                chunk,
+            )
+            entries.update((row[0], row[1:]) for row in rows)
+        return entries
+
+    def plan(self, sources_by_destination, stats):
+        """Record files as planned unless the journal already has them for the same unchanged source."""
+        entries = self.get_many(sources_by_destination)
+        planned = [
+            (destination, source, stats[source].st_size, stats[source].st_mtime, PLANNED)
+            for destination, source in sources_by_destination.items()
+            if entries.get(destination, (None, None, None))[:3]
+            != (source, stats[source].st_size, stats[source].st_mtime)
+        ]
+        with self.lock:
+            self.conn.executemany(
+                """
+                INSERT OR REPLACE INTO import_journal
+                (destination, source, file_size, mtime, status) VALUES (?, ?, ?, ?, ?)
+            """,
+                planned,
+            )
+            self.conn.commit()
+        return self.get_many(sources_by_destination)
+
+    def set_status(self, destination, status, content_hash=None, hash_algorithm=None):
+        with self.lock:
+            self.conn.execute(
+                """
+                UPDATE import_journal SET status = ?, content_hash = ?, hash_algorithm = ?
+                WHERE destination = ?
+            """,
+                (status, content_hash, hash_algorithm, destination),
+            )
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class ImportJob:
+    """Copies files into a library folder through an IOScheduler and adds the RAW files to photo_index.
+
+    Each file is hashed while it is copied, so the index rows need no second
+    read. Progress can be polled from another thread with progress(), and
+    finished and error.
+
+    Every file is tracked in an ImportJournal in its own database, so
+    copying never waits on a transaction in the index database. Running the
+    same import again skips files the journal has verified and whose copy is
+    unchanged, and copies again anything missing or whose copy doesn't match
+    its source.
+    """
+
+    def __init__(
+        self,
+        files,
+        destination_folder,
+        database=None,
+        workers=None,
+        journal_database=DEFAULT_JOURNAL_DB,
+    ):
+        self.files = files
+        self.destination_folder = destination_folder
+        self.database = database
+        self.journal_database = journal_database
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.stats = {file: os.stat(file) for file in files}
+        self.total_bytes = sum(stat.st_size for stat in self.stats.values())
+        self.bytes_done = 0
+        self.files_done = 0
+        self.copied = []
+        self.resumed = []
+        self.skipped = []
+        self.failed = []
+        # Copies whose content the index already has under another path
+        self.already_indexed = []
+        self.started = None
+        self.finished = False
+        # The exception that stopped the import, if any
+        self.error = None
+
+    def add_bytes(self, n):
+        with self.lock:
+            self.bytes_done += n
+
+    def progress(self):
+        """Return (files_done, total_files, bytes_done, total_bytes, bytes_per_second)."""
+        with self.lock:
+            elapsed = time.monotonic() - self.started if self.started else 0
+            rate = self.bytes_done / elapsed if elapsed > 0 else 0
+            return (
+                self.files_done,
+                len(self.files),
+                self.bytes_done,
+                self.total_bytes,
+                rate,
+            )
+
+    def destination(self, source):
+        return os.path.join(self.destination_folder, os.path.basename(source))
+
+    def copy_file(self, source, entry, journal, algorithm, read_size=None):
+        """Copy source unless the journal shows an earlier run finished it; return (outcome, content_hash, algorithm)."""
+        destination = self.destination(source)
+        source_stat = self.stats[source]
+        _, _, _, status, content_hash, content_algorithm = entry
+        try:
+            destination_stat = os.stat(destination)
+        except FileNotFoundError:
+            destination_stat = None
+
+        if destination_stat is not None:
+            unchanged = (destination_stat.st_size, destination_stat.st_mtime) == (
+                source_stat.st_size,
+                source_stat.st_mtime,
+            )
+            if status == VERIFIED and unchanged:
+                self.add_bytes(source_stat.st_size)
+                return "resumed", content_hash, content_algorithm
+            if status == PLANNED:
+                print(f"Warning: File {destination} already exists in destination folder.")
+                self.add_bytes(source_stat.st_size)
+                return "skipped", None, None
+            # Left by an interrupted run, keep it if it matches the source
+            if unchanged:
+                content_hash = compute_hash(source, algorithm, read_size)
+                if compute_hash(destination, algorithm) == content_hash:
+                    journal.set_status(destination, VERIFIED, content_hash, algorithm)
+                    self.add_bytes(source_stat.st_size)
+                    return "resumed", content_hash, algorithm
+
+        journal.set_status(destination, COPYING)
+        content_hash = copy_and_hash(
+            source, destination, algorithm, self.add_bytes, read_size
+        )
+        journal.set_status(destination, VERIFIED, content_hash, algorithm)
+        return "copied", content_hash, algorithm
+
+    def run(self):
+        """Copy and index the files, setting finished once done.
+
+        An error that stops the import is printed and kept in error, for
+        whoever polls the job to show.
+        """
+        self.started = time.monotonic()
+        conn = None
+        journal = None
+        try:
+            os.makedirs(self.destination_folder, exist_ok=True)
+
+            algorithm = DEFAULT_HASH_ALGORITHM
+            if self.database is not None:
+                conn = sqlite3.connect(self.database, timeout=INDEX_BUSY_TIMEOUT)
+                create_photo_index_table(conn.cursor())
+                algorithm = get_hash_algorithm(conn.cursor())
+                conn.commit()
+
+            journal = ImportJournal(self.journal_database)
+            entries = journal.plan(
+                {self.destination(source): source for source in self.files}, self.stats
+            )
+
+            rows = []
+            # Copies run as many at once as the card (or other source device)
+            # handles well, unless workers is given
+            with IOScheduler(self.workers) as scheduler:
+                futures = {
+                    scheduler.submit(
+                        self.copy_file,
+                        source,
+                        entries[self.destination(source)],
+                        journal,
+                        algorithm,
+                        stat=stat,
+                    ): source
+                    for source, stat in locality_order(list(self.stats.items()))
+                }
+                for future in as_completed(futures):
+                    source = futures[future]
+                    destination = self.destination(source)
+                    try:
+                        outcome, content_hash, content_algorithm = future.result()
+                        # Resumed files are indexed again in case the run that
+                        # copied them stopped before writing the index
+                        if outcome != "skipped" and destination.lower().endswith(
+                            tuple(raw_extensions)
+                        ):
+                            rows.append(
+                                self.index_row(destination, content_hash, content_algorithm)
+                            )
+                    except OSError as e:
+                        print(f"Error copying file: {e}")
+                        self.failed.append(str(e))
+                    else:
+                        if outcome == "skipped":
+                            self.skipped.append(source)
+                        else:
+                            getattr(self, outcome).append(destination)
+                    with self.lock:
+                        self.files_done += 1
+
+            if conn is not None:
+                rows = self.unindexed_rows(conn.cursor(), rows, algorithm)
+                write_batch_to_db(conn.cursor(), rows)
+                refresh_summaries(conn.cursor())
+                conn.commit()
+        except Exception as e:
+            self.error = e
+            print(f"Error importing files: {e}")
+        finally:
+            if journal is not None:
+                journal.close()
+            if conn is not None:
+                conn.close()
+            self.finished = True
+
+    def unindexed_rows(self, cursor, rows, algorithm):
+        """Return the index_row rows whose content photo_index doesn't have yet.
+
+        Checked like IndexWriter.write_file does, so a copy of a file indexed
+        on its fingerprint alone isn't added a second time.
+        """
+        unindexed = []
+        for row in rows:
+            filepath, content_hash, content_algorithm = row[0], row[3], row[4]
+            matches = find_fingerprint_matches(cursor, row[8], row[6])
+            match = None
+            if matches:
+                file_hashes = {}
+                if content_hash is not None:
+                    file_hashes[content_algorithm] = content_hash
+                match = find_same_content(cursor, filepath, matches, algorithm, file_hashes)
+            if match is None:
+                unindexed.append(row)
+            elif match[1] != filepath:
+                print(f"Already indexed: {filepath} is a copy of {match[1]}")
+                self.already_indexed.append(filepath)
+        return unindexed
+
+    def index_row(self, destination, content_hash, algorithm):
+        stat = os.stat(destination)
+        return (
+            os.path.abspath(destination),
+            os.path.basename(self.destination_folder.rstrip(os.sep)),
+            os.path.basename(destination),
+            content_hash,
+            algorithm,
+            datetime.fromtimestamp(stat.st_mtime).isoformat(),
+            stat.st_size,
+            stat.st_mtime,
+            compute_fingerprint(destination, stat.st_size),
+            None,
+            read_capture_time(destination, stat),
+        )
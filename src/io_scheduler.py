@@ -0,0 +1,242 @@
+import os
+import re
+import subprocess
+import sys
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from profiling import stats
+
+# Concurrent reads and read size for each kind of device. Card readers and
+# spinning disks slow down when several files are read at once, SSDs and
+# network shares need several requests in flight to reach full speed, and
+# large reads cut the per-request overhead of USB and network round trips.
+DEVICE_PROFILES = {
+    "card": (2, 4 * 1024 * 1024),
+    "hdd": (1, 8 * 1024 * 1024),
+    "ssd": (8, 1024 * 1024),
+    "network": (8, 4 * 1024 * 1024),
+    "unknown": (4, 1024 * 1024),
+}
+
+NETWORK_FILESYSTEMS = {
+    "nfs",
+    "nfs4",
+    "cifs",
+    "smb3",
+    "smbfs",
+    "afpfs",
+    "webdav",
+    "davfs",
+    "fuse.sshfs",
+    "9p",
+}
+# Filesystems cameras format their cards with
+CARD_FILESYSTEMS = {"vfat", "msdos", "exfat", "fat32"}
+MEMORY_FILESYSTEMS = {"tmpfs", "ramfs"}
+
+Device = namedtuple("Device", ["key", "kind", "workers", "read_size"])
+
+devices = {}
+devices_lock = threading.Lock()
+mounts = None
+
+
+def read_mounts():
+    """Return [(mount point, filesystem type)], longest mount point first."""
+    table = []
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/mounts") as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) >= 3:
+                        # Spaces and tabs in mount points are octal escapes
+                        mount = re.sub(
+                            r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[1]
+                        )
+                        table.append((mount, fields[2]))
+        except OSError:
+            pass
+    elif sys.platform == "darwin":
+        try:
+            output = subprocess.run(
+                ["mount"], capture_output=True, text=True, timeout=5
+            ).stdout
+        except (OSError, subprocess.SubprocessError):
+            output = ""
+        for line in output.splitlines():
+            match = re.match(r"^.* on (.*) \(([^,)]+)", line)
+            if match:
+                table.append((match.group(1), match.group(2)))
+    return sorted(table, key=lambda entry: len(entry[0]), reverse=True)
+
+
+def find_mount(table, path):
+    for mount, fs_type in table:
+        if path == mount or path.startswith(os.path.join(mount, "")):
+            return mount, fs_type
+    return None, None
+
+
+def filesystem_type(path, st_dev):
+    """Return the type of the filesystem holding path, whose device is st_dev, or None.
+
+    The mount table is cached, and read again when the mount it gives for
+    path is on another device, as for a card mounted since it was read.
+    """
+    global mounts
+    path = os.path.realpath(path)
+    if mounts is not None:
+        mount, fs_type = find_mount(mounts, path)
+        try:
+            if mount is not None and os.stat(mount).st_dev == st_dev:
+                return fs_type
+        except OSError:
+            pass
+    mounts = read_mounts()
+    return find_mount(mounts, path)[1]
+
+
+def block_device_kind(st_dev):
+    """Classify a Linux block device from sysfs as card, hdd or ssd, or return None."""
+    try:
+        device = os.path.realpath(f"/sys/dev/block/{os.major(st_dev)}:{os.minor(st_dev)}")
+    except (OSError, ValueError):
+        return None
+    if not os.path.isdir(device):
+        return None
+    if not os.path.isdir(os.path.join(device, "queue")):
+        # A partition, whose disk is its parent
+        device = os.path.dirname(device)
+
+    def read_flag(name):
+        try:
+            with open(os.path.join(device, name)) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    if "/usb" in device or os.path.basename(device).startswith("mmcblk"):
+        return "card"
+    if read_flag("removable") == "1":
+        return "card"
+    rotational = read_flag("queue/rotational")
+    if rotational == "1":
+        return "hdd"
+    if rotational == "0":
+        return "ssd"
+    return None
+
+
+def windows_drive_kind(path):
+    import ctypes
+
+    drive = os.path.splitdrive(os.path.abspath(path))[0]
+    drive_type = ctypes.windll.kernel32.GetDriveTypeW(ctypes.c_wchar_p(drive + "\\"))
+    # DRIVE_REMOVABLE and DRIVE_REMOTE; fixed drives can't be told apart cheaply
+    return {2: "card", 4: "network"}.get(drive_type)
+
+
+def device_kind(path, st_dev):
+    """Return the DEVICE_PROFILES kind of the device holding path."""
+    if sys.platform == "win32":
+        return windows_drive_kind(path) or "unknown"
+    fs_type = filesystem_type(path, st_dev)
+    if fs_type in NETWORK_FILESYSTEMS:
+        return "network"
+    if fs_type in MEMORY_FILESYSTEMS:
+        return "ssd"
+    kind = block_device_kind(st_dev) if sys.platform.startswith("linux") else None
+    if kind is None and fs_type in CARD_FILESYSTEMS:
+        kind = "card"
+    return kind or "unknown"
+
+
+def get_device(path, stat=None):
+    """Return the Device holding path, detected once per device and then cached.
+
+    stat may be passed when the caller has it already; stats from
+    os.scandir on Windows have no st_dev, so the path is stat'ed then.
+    """
+    st_dev = stat.st_dev if stat is not None and stat.st_dev else os.stat(path).st_dev
+    with devices_lock:
+        device = devices.get(st_dev)
+    if device is None:
+        kind = device_kind(path, st_dev)
+        workers, read_size = DEVICE_PROFILES[kind]
+        device = Device(st_dev, kind, workers, read_size)
+        with devices_lock:
+            devices[st_dev] = device
+    return device
+
+
+def device_read_size(path):
+    """Return the read size for whole-file reads of path, based on its device."""
+    try:
+        return get_device(path).read_size
+    except OSError:
+        return DEVICE_PROFILES["unknown"][1]
+
+
+def locality_order(items):
+    """Sort (file_path, stat, ...) items by device, folder and inode.
+
+    Inode order roughly follows where files were written on disk, so reads
+    seek less on spinning disks and a card reader streams sequentially. On
+    Windows, where os.scandir stats have no inode, files keep name order.
+    """
+    return sorted(
+        items,
+        key=lambda item: (
+            item[1].st_dev,
+            os.path.dirname(item[0]),
+            item[1].st_ino,
+            item[0],
+        ),
+    )
+
+
+class IOScheduler:
+    """Runs file reads on one thread pool per device, each sized for its kind of device.
+
+    A card reader, a local SSD and a NAS in the same run each get their own
+    workers, so a slow device never holds back a fast one, and none is given
+    more concurrent reads than it handles well. workers overrides the
+    concurrency of every device. Submitted functions are called with the
+    device's read size as the read_size keyword.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.pools = {}
+
+    def device(self, path, stat=None):
+        device = get_device(path, stat)
+        if self.workers is not None:
+            device = device._replace(workers=self.workers)
+        return device
+
+    def submit(self, fn, path, *args, stat=None):
+        device = self.device(path, stat)
+        with self.lock:
+            pool = self.pools.get(device.key)
+            if pool is None:
+                stats.count(f"io_devices_{device.kind}")
+                pool = ThreadPoolExecutor(max_workers=device.workers)
+                self.pools[device.key] = pool
+        return pool.submit(fn, path, *args, read_size=device.read_size)
+
+    def shutdown(self):
+        with self.lock:
+            pools = list(self.pools.values())
+            self.pools.clear()
+        for pool in pools:
+            pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
@@ -1,6 +1,17 @@
 import os
+import queue
 import sqlite3
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from collections import defaultdict
 from datetime import datetime
+from functools import partial
 import argparse
 from tqdm import tqdm
 from itertools import groupby
@@ -9,115 +20,659 @@ from utils import (
     import_photo_metadata,
     get_file_creation_time,
     raw_extensions,
-    compute_md5,
-    is_image_unique_by_md5,
+    compute_hash,
+    is_image_unique_by_hash,
+    create_photo_index_table,
+    load_indexed_files,
+    remove_duplicate_paths,
+    compute_fingerprint,
+    find_fingerprint_matches,
+    find_same_content,
+    get_hash_algorithm,
+    set_hash_algorithm,
+    HASH_ALGORITHMS,
+    DEFAULT_HASH_ALGORITHM,
+    configure_bulk_writes,
+    walk_files,
+    write_batch_to_db,
+    refresh_summaries,
+    get_library_roots,
+    set_library_root,
+    locate_in_roots,
+    find_similar_images,
+    DEFAULT_PERCEPTUAL_DISTANCE,
 )
+from exif import read_capture_time
+from watcher import open_watcher, outermost_folders
+from io_scheduler import IOScheduler, locality_order
+from profiling import profiled, stats
 
 
-def write_batch_to_db(cursor, batch_data):
-    """Write batch data to the database."""
-    try:
-        cursor.executemany(
-            """
-            INSERT INTO photo_index (filepath, folder, filename, md5_hash, creation_time)
-            VALUES (?, ?, ?, ?, ?)
-        """,
-            batch_data,
+class FingerprintCache:
+    """{fingerprint: filepath} for indexed rows, kept between runs by watch_photos.
+
+    Each load only reads rows added since the last one, so a run over a few
+    new files doesn't read the fingerprint of every file in the index.
+    """
+
+    def __init__(self):
+        self.paths = {}
+        self.last_id = 0
+
+    def load(self, cursor):
+        cursor.execute(
+            "SELECT id, fingerprint, filepath FROM photo_index WHERE id > ? ORDER BY id",
+            (self.last_id,),
+        )
+        for row_id, fingerprint, filepath in cursor.fetchall():
+            if fingerprint is not None:
+                self.paths[fingerprint] = filepath
+            self.last_id = row_id
+        return self.paths
+
+
+class IndexWriter(threading.Thread):
+    """Single thread that owns the database connection and writes hashed files to photo_index.
+
+    Hashed files are handed over through a bounded queue, so the walk and the
+    hashers never touch SQLite and memory stays flat however far they get ahead.
+    Rows are written in one long transaction, committed every COMMIT_INTERVAL
+    seconds so an interrupted run keeps most of its work.
+    """
+
+    COMMIT_INTERVAL = 30
+
+    def __init__(
+        self,
+        database,
+        directory,
+        batch_size=100,
+        incremental=False,
+        hash_algorithm=None,
+        root_name=None,
+        perceptual=False,
+        fingerprints=None,
+    ):
+        super().__init__(daemon=True)
+        self.conn = sqlite3.connect(database, check_same_thread=False)
+        stats.trace_queries(self.conn)
+        configure_bulk_writes(self.conn)
+        self.cursor = self.conn.cursor()
+
+        # Create the table if it doesn't exist
+        create_photo_index_table(self.cursor)
+        if hash_algorithm is not None:
+            set_hash_algorithm(self.cursor, hash_algorithm)
+        if root_name is not None:
+            set_library_root(self.cursor, root_name, directory)
+        self.conn.commit()
+        self.algorithm = get_hash_algorithm(self.cursor)
+        self.roots = get_library_roots(self.cursor)
+
+        self.queue = queue.Queue(maxsize=batch_size * 4)
+        self.batch_size = batch_size
+        self.incremental = incremental
+        self.perceptual = perceptual
+        if perceptual:
+            # Needs PIL, which plain indexing doesn't
+            from phash import compute_perceptual_hash
+
+            self.compute_perceptual_hash = compute_perceptual_hash
+        self.changes = {"new": 0, "changed": 0, "moved": 0, "deleted": 0, "unchanged": 0}
+        self.indexed = {}
+        if incremental:
+            # One row per path, so each is reconciled with its file below
+            for path in remove_duplicate_paths(self.cursor, directory):
+                print(f"Removed duplicate rows for: {path}")
+                self.changes["deleted"] += 1
+            self.indexed = load_indexed_files(self.cursor, directory, self.algorithm)
+        self.batch_data = []
+        self.last_commit = time.monotonic()
+        # Set if writing fails, see run
+        self.error = None
+
+        # Read by the hashing pool to guess which files will need a full hash
+        self.fingerprints = (fingerprints or FingerprintCache()).load(self.cursor)
+        # Sizes of rows indexed before fingerprints were stored (None if unknown)
+        self.cursor.execute(
+            "SELECT DISTINCT file_size FROM photo_index WHERE fingerprint IS NULL"
+        )
+        self.unfingerprinted_sizes = {row[0] for row in self.cursor.fetchall()}
+
+    def run(self):
+        item = ()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                try:
+                    with stats.stage("index_write", item[0]):
+                        self.write_file(*item)
+                except OSError as e:
+                    # e.g. a matching file removed before it could be compared
+                    print(f"Skipping file: {item[0]} - {e}")
+
+            # Insert any remaining data
+            self.flush()
+
+            if self.incremental:
+                self.remove_deleted()
+            refresh_summaries(self.cursor)
+            self.conn.commit()
+        except Exception as e:
+            # index_photos raises this once it sees it; until then keep taking
+            # items, so it never blocks on a full queue
+            self.error = e
+            print(f"Error writing the index: {e}")
+            while item is not None:
+                item = self.queue.get()
+        finally:
+            self.conn.close()
+
+    def flush(self):
+        """Write pending rows, so queries on this connection see them."""
+        if self.batch_data:
+            write_batch_to_db(self.cursor, self.batch_data, self.roots)
+            self.batch_data.clear()
+        if time.monotonic() - self.last_commit >= self.COMMIT_INTERVAL:
+            refresh_summaries(self.cursor)
+            self.conn.commit()
+            self.last_commit = time.monotonic()
+
+    def hash_file(self, file_path, stat, known, read_size=None):
+        """Fingerprint a file, and compute its full hash only if it is likely to be needed.
+
+        Runs on the IOScheduler's pool for the file's device. Returns None if
+        the file can't be read, e.g. because it was removed since the walk.
+        """
+        try:
+            fingerprint = compute_fingerprint(file_path, stat.st_size)
+            stat_changed = known is not None and known[:2] != (stat.st_size, stat.st_mtime)
+            # A file matching only its own row, as in a rerun without
+            # --incremental, needs no hash
+            collides = self.fingerprints.get(fingerprint, file_path) != file_path
+            content_hash = None
+            if collides or (stat_changed and known[2] is not None):
+                content_hash = compute_hash(file_path, self.algorithm, read_size)
+        except OSError as e:
+            print(f"Skipping file: {file_path} - {e}")
+            return None
+        perceptual_hash = None
+        if self.perceptual:
+            perceptual_hash = self.compute_perceptual_hash(file_path)
+        return (
+            file_path,
+            stat,
+            known,
+            fingerprint,
+            content_hash,
+            perceptual_hash,
+            read_capture_time(file_path, stat),
         )
-    except sqlite3.IntegrityError as e:
-        print(f"Error inserting batch: {e}")
-        for item in batch_data:
+
+    def write_file(
+        self,
+        file_path,
+        stat,
+        known,
+        fingerprint,
+        content_hash,
+        perceptual_hash=None,
+        capture_time=None,
+    ):
+        cursor = self.cursor
+        folder = os.path.basename(os.path.dirname(file_path))
+        filename = os.path.basename(file_path)
+        creation_time = datetime.fromtimestamp(stat.st_mtime).isoformat()
+
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime):
+            # Indexed before fingerprints (or perceptual hashes, or capture
+            # times) were recorded
+            cursor.execute(
+                """
+                UPDATE photo_index
+                SET fingerprint = ?, perceptual_hash = COALESCE(?, perceptual_hash),
+                    capture_time = ?
+                WHERE filepath = ?
+            """,
+                (fingerprint, perceptual_hash, capture_time, file_path),
+            )
+            self.fingerprints[fingerprint] = file_path
+            self.changes["unchanged"] += 1
+            return
+
+        if known is not None:
+            # Already indexed at this path, but modified (or indexed before
+            # size and mtime were recorded)
             try:
                 cursor.execute(
                     """
-                    INSERT INTO photo_index (filepath, folder, filename, md5_hash, creation_time)
-                    VALUES (?, ?, ?, ?, ?)
+                    UPDATE photo_index
+                    SET content_hash = ?, hash_algorithm = ?, creation_time = ?, file_size = ?, mtime = ?, fingerprint = ?,
+                        perceptual_hash = ?, capture_time = ?
+                    WHERE filepath = ?
                 """,
-                    item,
+                    (
+                        content_hash,
+                        self.algorithm if content_hash is not None else None,
+                        creation_time,
+                        stat.st_size,
+                        stat.st_mtime,
+                        fingerprint,
+                        perceptual_hash,
+                        capture_time,
+                        file_path,
+                    ),
                 )
             except sqlite3.IntegrityError as e:
-                print(f"Error inserting file: {item[0]} with MD5 hash: {item[3]} - {e}")
+                print(f"Error updating file: {file_path} with hash: {content_hash} - {e}")
+            self.fingerprints[fingerprint] = file_path
+            if known[2] is not None:
+                changed = known[2] != content_hash
+            else:
+                changed = known[3] is not None and known[3] != fingerprint
+            self.changes["changed" if changed else "unchanged"] += 1
+            return
+
+        # Only compare full hashes when the fingerprint matches an indexed file
+        matches = []
+        if (
+            fingerprint in self.fingerprints
+            or stat.st_size in self.unfingerprinted_sizes
+            or None in self.unfingerprinted_sizes
+        ):
+            self.flush()
+            matches = find_fingerprint_matches(cursor, fingerprint, stat.st_size)
+            self.unfingerprinted_sizes.discard(stat.st_size)
+            self.unfingerprinted_sizes.discard(None)
+        # Only added after the check, or every new file would look like a collision
+        self.fingerprints[fingerprint] = file_path
+        if matches:
+            if any(match[1] == file_path for match in matches) and self.is_unchanged(
+                file_path, stat
+            ):
+                # Indexed before at this path (a run without --incremental)
+                self.changes["unchanged"] += 1
+                return
+            file_hashes = {}
+            if content_hash is not None:
+                file_hashes[self.algorithm] = content_hash
+            match = find_same_content(
+                cursor, file_path, matches, self.algorithm, file_hashes
+            )
+            content_hash = file_hashes.get(self.algorithm)
+            if match is None and self.incremental:
+                # A vanished file that was never fully hashed can only be
+                # matched on its fingerprint
+                match = next(
+                    (m for m in matches if m[2] is None and not os.path.exists(m[1])),
+                    None,
+                )
+            if match is not None:
+                if self.incremental and not os.path.exists(match[1]):
+                    # Same content, old path is gone: the file was moved
+                    cursor.execute(
+                        """
+                        UPDATE photo_index
+                        SET filepath = ?, folder = ?, filename = ?, file_size = ?, mtime = ?,
+                            content_hash = COALESCE(?, content_hash),
+                            hash_algorithm = COALESCE(?, hash_algorithm),
+                            perceptual_hash = COALESCE(?, perceptual_hash),
+                            capture_time = COALESCE(?, capture_time),
+                            root = ?, relative_path = ?
+                        WHERE id = ?
+                    """,
+                        (
+                            file_path,
+                            folder,
+                            filename,
+                            stat.st_size,
+                            stat.st_mtime,
+                            content_hash,
+                            self.algorithm if content_hash is not None else None,
+                            perceptual_hash,
+                            capture_time,
+                            *locate_in_roots(self.roots, file_path),
+                            match[0],
+                        ),
+                    )
+                    self.indexed.pop(match[1], None)
+                    self.changes["moved"] += 1
+                return
+            if content_hash is None:
+                content_hash = compute_hash(file_path, self.algorithm)
+
+        self.batch_data.append(
+            (
+                file_path,
+                folder,
+                filename,
+                content_hash,
+                self.algorithm if content_hash is not None else None,
+                creation_time,
+                stat.st_size,
+                stat.st_mtime,
+                fingerprint,
+                perceptual_hash,
+                capture_time,
+            )
+        )
+        self.changes["new"] += 1
+
+        # Batch insert if the batch size is reached
+        if len(self.batch_data) >= self.batch_size:
+            self.flush()
+
+    def is_unchanged(self, file_path, stat):
+        """Return True if file_path is indexed with its current size and mtime."""
+        self.cursor.execute(
+            "SELECT 1 FROM photo_index WHERE filepath = ? AND file_size = ? AND mtime = ?",
+            (file_path, stat.st_size, stat.st_mtime),
+        )
+        return self.cursor.fetchone() is not None
+
+    def remove_deleted(self):
+        # Anything left was indexed under this directory but not found in the walk
+        deleted = [(path,) for path in self.indexed if not os.path.exists(path)]
+        self.cursor.executemany("DELETE FROM photo_index WHERE filepath = ?", deleted)
+        self.changes["deleted"] += len(deleted)
+        for (path,) in deleted:
+            print(f"Removed from index: {path}")
 
 
-def index_photos(directory, database, verbose, batch_size=100):
-    """Index all RAW photos in the directory."""
+def hash_file_fully(file_path, stat, known, algorithm="md5", read_size=None):
+    """Fingerprint and hash a file, for verbose runs that print every hash."""
+    try:
+        fingerprint = compute_fingerprint(file_path, stat.st_size)
+        content_hash = compute_hash(file_path, algorithm, read_size)
+    except OSError as e:
+        print(f"Skipping file: {file_path} - {e}")
+        return None
+    return (
+        file_path,
+        stat,
+        known,
+        fingerprint,
+        content_hash,
+        None,
+        read_capture_time(file_path, stat),
+    )
+
+
+def hash_files(scheduler, hash_file, pending):
+    """Run hash_file over (file_path, stat, known) items on an IOScheduler, yielding results as they finish.
+
+    Files are submitted in device, folder and inode order, and at most twice
+    as many files as a device has workers are queued for it at once.
+    """
+    in_flight = {}
+    queued = defaultdict(int)
+    for file_path, stat, known in locality_order(pending):
+        try:
+            device = scheduler.device(file_path, stat)
+        except OSError as e:
+            # Removed since the walk, and its stat had no device to go by
+            print(f"Skipping file: {file_path} - {e}")
+            continue
+        while queued[device.key] >= device.workers * 2:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                queued[in_flight.pop(future)] -= 1
+                yield future.result()
+        future = scheduler.submit(hash_file, file_path, stat, known, stat=stat)
+        in_flight[future] = device.key
+        queued[device.key] += 1
+    for future in as_completed(in_flight):
+        yield future.result()
+
+
+def index_photos(
+    directory,
+    database,
+    verbose,
+    batch_size=100,
+    incremental=False,
+    workers=None,
+    hash_algorithm=None,
+    root_name=None,
+    perceptual=False,
+    fingerprints=None,
+):
+    """Index all RAW photos in the directory.
+
+    With incremental=True, files whose size and mtime match their photo_index row
+    are skipped without being read, and moved or deleted files are reconciled.
+    Files are fingerprinted through an IOScheduler, with as many threads per
+    device as suits it (or `workers` threads each), and written by a single
+    IndexWriter thread; the full hash is only computed when a fingerprint collides.
+    hash_algorithm switches the database to another of HASH_ALGORITHMS.
+    root_name records the directory as a named library root, see set_library_root.
+    perceptual=True also stores a perceptual hash of each file's preview, for
+    finding near-duplicates; incremental runs fill it in for indexed files.
+    Each file's EXIF capture time is stored too, and likewise filled in by
+    incremental runs for files indexed before it was.
+    fingerprints is a FingerprintCache to reuse from an earlier run.
+    """
     # Add other RAW file extensions as needed
 
+    writer = None
     if not verbose:
-        # Connect to the SQLite database
-        conn = sqlite3.connect(database)
-        cursor = conn.cursor()
+        writer = IndexWriter(
+            database,
+            directory,
+            batch_size,
+            incremental,
+            hash_algorithm,
+            root_name,
+            perceptual,
+            fingerprints,
+        )
+        writer.start()
+        hash_file = writer.hash_file
+    else:
+        hash_file = partial(
+            hash_file_fully, algorithm=hash_algorithm or DEFAULT_HASH_ALGORITHM
+        )
+    indexed = writer.indexed if writer is not None else {}
+    unchanged = 0
 
-        # Create the table if it doesn't exist
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS photo_index (
-                id INTEGER PRIMARY KEY,
-                filepath TEXT,
-                folder TEXT,
-                filename TEXT,
-                md5_hash TEXT UNIQUE,
-                creation_time TEXT
+    folders = tqdm(desc="Folders")
+    try:
+        with IOScheduler(workers) as scheduler:
+            for root, files, folders_left in walk_files(directory):
+                # The total grows as the walk discovers more folders
+                folders.total = folders.n + 1 + folders_left
+                folders.update(1)
+
+                pending = []
+                for file_path, stat in files:
+                    known = indexed.pop(file_path, None)
+                    if (
+                        known is not None
+                        and known[:2] == (stat.st_size, stat.st_mtime)
+                        and known[3] is not None
+                        and (known[4] is not None or not perceptual)
+                        and known[5] is not None
+                    ):
+                        unchanged += 1
+                        continue
+                    pending.append((file_path, stat, known))
+
+                # Gets iterations folder name to mention in
+                iter_folder_name = os.path.basename(root)
+                with tqdm(
+                    total=len(files), desc=f"Files: {iter_folder_name}", leave=False
+                ) as progress:
+                    progress.update(len(files) - len(pending))
+                    for result in hash_files(scheduler, hash_file, pending):
+                        progress.update(1)
+                        if result is None:
+                            continue
+                        (
+                            file_path,
+                            stat,
+                            known,
+                            fingerprint,
+                            content_hash,
+                            perceptual_hash,
+                            capture_time,
+                        ) = result
+                        if verbose:
+                            folder = os.path.basename(os.path.dirname(file_path))
+                            creation_time = datetime.fromtimestamp(stat.st_mtime).isoformat()
+                            print(
+                                f"Folder: {folder}, Filename: {os.path.basename(file_path)}, Hash: {content_hash}, Fingerprint: {fingerprint}, Creation Time: {creation_time}, Capture Time: {capture_time}, Filepath: {file_path}"
+                            )
+                        else:
+                            writer.queue.put(result)
+                            if writer.error is not None:
+                                raise writer.error
+    finally:
+        folders.close()
+        # Always stop the writer, so the rows written so far are committed
+        if writer is not None:
+            writer.queue.put(None)
+            writer.join()
+
+    if writer is not None:
+        if writer.error is not None:
+            raise writer.error
+
+        if incremental:
+            changes = writer.changes
+            changes["unchanged"] += unchanged
+            print(
+                "Changes: "
+                + ", ".join(f"{count} {change}" for change, count in changes.items())
             )
-        """
-        )
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_md5 ON photo_index (md5_hash)")
+
+
+def watch_photos(
+    directory,
+    database,
+    workers=None,
+    debounce=10,
+    min_interval=60,
+    max_delay=600,
+    poll_interval=60,
+    polling=False,
+):
+    """Keep photo_index current for directory, indexing folders as RAW files appear in them.
+
+    Starts with an incremental index of the whole directory, then runs an
+    incremental index of the changed folders once no change has been seen for
+    `debounce` seconds, so files still being synced aren't hashed half written.
+    Runs are at least `min_interval` seconds apart, so a large sync is indexed
+    in a few runs rather than one per file, and changes wait no longer than
+    `max_delay` seconds for a quiet moment.
+    """
+    watcher = open_watcher(directory, poll_interval, polling)
+    print(f"Watching {directory} with {type(watcher).__name__}")
+    fingerprints = FingerprintCache()
+
+    def run_index(folder):
+        """Index folder, returning False if the run failed."""
+        try:
+            index_photos(
+                folder,
+                database,
+                False,
+                incremental=True,
+                workers=workers,
+                fingerprints=fingerprints,
+            )
+        except Exception as e:
+            print(f"Error indexing {folder}: {e}")
+            return False
+        return True
+
+    dirty = set()
+    first_change = last_change = None
+    if not run_index(directory):
+        dirty.add(os.path.abspath(directory))
+        first_change = last_change = time.monotonic()
+    last_run = time.monotonic()
+    try:
+        while True:
+            changed = watcher.changed_folders(timeout=1)
+            now = time.monotonic()
+            if changed:
+                dirty.update(changed)
+                last_change = now
+                if first_change is None:
+                    first_change = now
+            if not dirty:
+                continue
+
+            settled = now - last_change >= debounce or now - first_change >= max_delay
+            if settled and now - last_run >= min_interval:
+                failed = set()
+                for folder in outermost_folders(dirty):
+                    print(f"Indexing changes in {folder}")
+                    if not run_index(folder):
+                        failed.add(folder)
+                # Failed folders stay dirty, to be retried on the next run
+                dirty = failed
+                last_run = time.monotonic()
+                first_change = last_change = last_run if dirty else None
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def vacuum_shards(databases, workers=4):
+    """Analyze and vacuum each index database on its own thread.
+
+    SQLite releases the GIL while it works, so shards on separate files (or
+    drives) are compacted in parallel.
+    """
+
+    def vacuum(database):
+        started = time.monotonic()
+        conn = sqlite3.connect(database)
+        create_photo_index_table(conn.cursor())
         conn.commit()
+        conn.execute("ANALYZE")
+        conn.execute("VACUUM")
+        conn.close()
+        return database, time.monotonic() - started
 
-    batch_data = []
-
-    folders = [folder for folder in os.walk(directory)]
-    for root, _, files in tqdm(folders, desc="Folders"):
-        files = [
-            file
-            for file in files
-            if any(file.lower().endswith(ext) for ext in raw_extensions)
-        ]
-
-        # Gets iterations folder name to mention in
-        iter_folder_name = os.path.basename(root)
-        for file in tqdm(files, desc=f"Files: {iter_folder_name}", leave=False):
-            file_path = os.path.abspath(os.path.join(root, file))
-            folder = os.path.basename(os.path.dirname(file_path))
-            filename = file
-            md5_hash = compute_md5(file_path)
-            creation_time = get_file_creation_time(file_path).isoformat()
-
-            if verbose:
-                print(
-                    f"Folder: {folder}, Filename: {filename}, MD5 Hash: {md5_hash}, Creation Time: {creation_time}, Filepath: {file_path}"
-                )
-            else:
-                # Check if the MD5 hash already exists in the database
-                cursor.execute(
-                    "SELECT 1 FROM photo_index WHERE md5_hash = ?", (md5_hash,)
-                )
-                if cursor.fetchone() is None:
-                    batch_data.append(
-                        (file_path, folder, filename, md5_hash, creation_time)
-                    )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for database, seconds in executor.map(vacuum, databases):
+            print(f"Vacuumed {database} in {seconds:.1f}s")
 
-                # Check for duplicates within the batch
-                batch_md5_hashes = [item[3] for item in batch_data]
-                if batch_md5_hashes.count(md5_hash) > 1:
-                    print(
-                        f"Duplicate file in batch: {file_path} with MD5 hash: {md5_hash}"
-                    )
-                    batch_data = [item for item in batch_data if item[3] != md5_hash]
 
-                # Batch insert if the batch size is reached
-                if not verbose and len(batch_data) >= batch_size:
-                    write_batch_to_db(cursor, batch_data)
-                    conn.commit()
-                    batch_data.clear()
+def find_similar_photos(files, database, max_distance=DEFAULT_PERCEPTUAL_DISTANCE):
+    """Print the indexed photos whose perceptual hash is close to each of files."""
+    from phash import compute_perceptual_hash
 
-    # Insert any remaining data
-    if batch_data:
-        write_batch_to_db(cursor, batch_data)
-        conn.commit()
+    conn = sqlite3.connect(database)
+    cursor = conn.cursor()
+    create_photo_index_table(cursor)
+    conn.commit()
+    for file_path in files:
+        perceptual_hash = compute_perceptual_hash(file_path)
+        if perceptual_hash is None:
+            print(f"{file_path}: no preview to compare")
+            continue
+        similar = find_similar_images(cursor, perceptual_hash, max_distance)
+        print(f"{file_path}: {len(similar)} similar")
+        for distance, _, filepath in similar:
+            print(f"  {distance:2d} bits  {filepath}")
+    conn.close()
 
-    if not verbose:
-        conn.close()
+
+def list_roots(database):
+    conn = sqlite3.connect(database)
+    cursor = conn.cursor()
+    create_photo_index_table(cursor)
+    conn.commit()
+    for name, path in sorted(get_library_roots(cursor).items()):
+        cursor.execute("SELECT COUNT(*) FROM photo_index WHERE root = ?", (name,))
+        print(f"{name}: {path} ({cursor.fetchone()[0]} files)")
+    conn.close()
 
 
 def import_photos(sd_card_directory, database):
@@ -139,7 +694,7 @@ def import_photos(sd_card_directory, database):
         for file in files:
             if any(file.lower().endswith(ext) for ext in raw_extensions):
                 file_path = os.path.abspath(os.path.join(root, file))
-                if is_image_unique_by_md5(file_path, cursor):
+                if is_image_unique_by_hash(file_path, cursor):
                     print(f"New file found: {file_path}")
 
     conn.close()
@@ -150,6 +705,18 @@ if __name__ == "__main__":
     DEFAULT_INDEX_DB = "data/photo_db_real.db.sqlite"
 
     parser = argparse.ArgumentParser(description="Manage and index RAW photos.")
+    parser.add_argument(
+        "--stats",
+        type=str,
+        default=None,
+        help="Write per-stage timings, bytes read, queries, cache hits and the slowest files to this JSON file.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Write a cProfile dump of the main thread to this file (open with pstats or snakeviz).",
+    )
     subparsers = parser.add_subparsers(dest="command")
 
     parser_index = subparsers.add_parser(
@@ -176,6 +743,127 @@ if __name__ == "__main__":
         default=100,
         help="The batch size for database insertion.",
     )
+    parser_index.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="Only hash new or changed files, and remove deleted files from the index.",
+    )
+    parser_index.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of files to hash in parallel on each device (default: chosen per device type).",
+    )
+    parser_index.add_argument(
+        "--hash-algorithm",
+        type=str,
+        choices=sorted(HASH_ALGORITHMS),
+        default=None,
+        help="Content hash to use for new hashes. Existing rows are rehashed when next compared.",
+    )
+    parser_index.add_argument(
+        "--perceptual-hash",
+        action="store_true",
+        default=False,
+        help="Also store a perceptual hash of each preview, for finding near-duplicates (needs PIL).",
+    )
+    parser_index.add_argument(
+        "--root",
+        type=str,
+        default=None,
+        help="Name the directory as a library root, storing paths relative to it.",
+    )
+
+    parser_roots = subparsers.add_parser(
+        "roots", help="List library roots, or add or move one."
+    )
+    parser_roots.add_argument(
+        "--database",
+        type=str,
+        default=DEFAULT_INDEX_DB,
+        help="The SQLite database file.",
+    )
+    parser_roots.add_argument(
+        "--set",
+        nargs=2,
+        metavar=("NAME", "PATH"),
+        default=None,
+        help="Add a root, or point an existing root at a new path (e.g. a drive mounted elsewhere).",
+    )
+
+    parser_similar = subparsers.add_parser(
+        "similar", help="Find indexed photos that look like the given files."
+    )
+    parser_similar.add_argument("files", type=str, nargs="+", help="Photos to look up.")
+    parser_similar.add_argument(
+        "--database",
+        type=str,
+        default=DEFAULT_INDEX_DB,
+        help="The SQLite database file.",
+    )
+    parser_similar.add_argument(
+        "--max-distance",
+        type=int,
+        default=DEFAULT_PERCEPTUAL_DISTANCE,
+        help="Bits the perceptual hashes may differ by.",
+    )
+
+    parser_vacuum = subparsers.add_parser(
+        "vacuum", help="Analyze and vacuum index databases in parallel."
+    )
+    parser_vacuum.add_argument(
+        "databases", type=str, nargs="+", help="The SQLite database files (shards)."
+    )
+    parser_vacuum.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of databases to vacuum at once.",
+    )
+
+    parser_watch = subparsers.add_parser(
+        "watch", help="Keep the index current as RAW photos are added to a directory."
+    )
+    parser_watch.add_argument(
+        "directory", type=str, help="The directory to watch for RAW photos."
+    )
+    parser_watch.add_argument(
+        "--database",
+        type=str,
+        default=DEFAULT_INDEX_DB,
+        help="The SQLite database file.",
+    )
+    parser_watch.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of files to hash in parallel on each device (default: chosen per device type).",
+    )
+    parser_watch.add_argument(
+        "--debounce",
+        type=float,
+        default=10,
+        help="Seconds without changes to wait for before indexing.",
+    )
+    parser_watch.add_argument(
+        "--min-interval",
+        type=float,
+        default=60,
+        help="Minimum seconds between index runs.",
+    )
+    parser_watch.add_argument(
+        "--poll-interval",
+        type=float,
+        default=60,
+        help="Seconds between scans when inotify isn't available.",
+    )
+    parser_watch.add_argument(
+        "--polling",
+        action="store_true",
+        default=False,
+        help="Scan for changes instead of using inotify.",
+    )
 
     # Import command
     parser_import = subparsers.add_parser(
@@ -196,18 +884,52 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    if args.command == "index":
-        index_photos(args.directory, args.database, args.verbose)
-    elif args.command == "import":
-        contents = import_photo_metadata(
-            args.sd_card_directory, file_type_set={"jpg", "jpeg"}
-        )
-        grouped_files = group_by_date(contents=contents)
+    with profiled(args.stats, args.profile):
+        if args.command == "index":
+            index_photos(
+                args.directory,
+                args.database,
+                args.verbose,
+                batch_size=args.batch_size,
+                incremental=args.incremental,
+                workers=args.workers,
+                hash_algorithm=args.hash_algorithm,
+                root_name=args.root,
+                perceptual=args.perceptual_hash,
+            )
+        elif args.command == "roots":
+            if args.set is not None:
+                conn = sqlite3.connect(args.database)
+                create_photo_index_table(conn.cursor())
+                set_library_root(conn.cursor(), *args.set)
+                refresh_summaries(conn.cursor())
+                conn.commit()
+                conn.close()
+            list_roots(args.database)
+        elif args.command == "similar":
+            find_similar_photos(args.files, args.database, args.max_distance)
+        elif args.command == "vacuum":
+            vacuum_shards(args.databases, args.workers)
+        elif args.command == "watch":
+            watch_photos(
+                args.directory,
+                args.database,
+                workers=args.workers,
+                debounce=args.debounce,
+                min_interval=args.min_interval,
+                poll_interval=args.poll_interval,
+                polling=args.polling,
+            )
+        elif args.command == "import":
+            contents = import_photo_metadata(
+                args.sd_card_directory, file_type_set={"jpg", "jpeg"}
+            )
+            grouped_files = group_by_date(contents=contents)
 
-        summary = [(k, len(grouped_files[k])) for k in grouped_files.keys()]
-        breakpoint()
+            summary = [(k, len(grouped_files[k])) for k in grouped_files.keys()]
+            breakpoint()
 
-        # import_photos(args.sd_card_directory, args.database)
+            # import_photos(args.sd_card_directory, args.database)
 # if __name__ == "__main__":
 #    directory = "test_data/"
 #    database = "database/photo_index.db.sqlite"
@@ -0,0 +1,40 @@
+from PIL import Image
+from profiling import stats
+from raw_preview import open_preview
+from utils import raw_extensions, to_perceptual_column
+
+# dHash compares neighbouring pixels of a HASH_SIZE x HASH_SIZE greyscale image
+HASH_SIZE = 8
+
+
+def compute_perceptual_hash(file_path):
+    """Return the 64-bit difference hash (dHash) of an image, or None if it can't be decoded.
+
+    RAW files are hashed from their embedded preview, and JPEGs are decoded
+    at a reduced scale, so this never reads or decodes a full-size image.
+    Re-encoded, resized or lightly edited copies of a photo get hashes within
+    a few bits of each other. The hash is returned in its signed SQLite form.
+    """
+    with stats.stage("perceptual_hash", file_path):
+        try:
+            if file_path.lower().endswith(tuple(raw_extensions)):
+                img = open_preview(file_path, (HASH_SIZE * 8, HASH_SIZE * 8))
+                if img is None:
+                    return None
+            else:
+                img = Image.open(file_path)
+                img.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+            img = img.convert("L").resize(
+                (HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS
+            )
+            pixels = list(img.getdata())
+        except (OSError, ValueError, SyntaxError):
+            return None
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return to_perceptual_column(value)
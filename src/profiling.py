@@ -0,0 +1,119 @@
+import cProfile
+import heapq
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+# Slowest items kept per stage
+SLOWEST_COUNT = 20
+
+
+class Stats:
+    """Per-stage timings and counters, collected from any thread while enabled.
+
+    Stages are named sections of work (walk, fingerprint, hash, sqlite_write,
+    thumbnail_decode, ...). Stages can nest, e.g. a hash inside an SQLite
+    lookup, so their times don't add up to the wall time. Counters hold bytes
+    read, queries issued and cache hits and misses. Nothing is recorded until
+    enable() is called, and a disabled stage() costs a single attribute check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.stages = defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+        self.counters = defaultdict(int)
+        self.slowest = defaultdict(list)
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+
+    def stage(self, name, item=None):
+        """Context manager timing one call of stage name; item (e.g. a file path) is kept if it is among the slowest."""
+        if not self.enabled:
+            return nullcontext()
+        return self.timed(name, item)
+
+    @contextmanager
+    def timed(self, name, item):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            with self.lock:
+                stage = self.stages[name]
+                stage["calls"] += 1
+                stage["seconds"] += seconds
+                if item is not None:
+                    slowest = self.slowest[name]
+                    if len(slowest) < SLOWEST_COUNT:
+                        heapq.heappush(slowest, (seconds, str(item)))
+                    elif seconds > slowest[0][0]:
+                        heapq.heapreplace(slowest, (seconds, str(item)))
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += n
+
+    def trace_queries(self, conn):
+        """Count the SQL statements run on an sqlite3 connection as the queries counter."""
+        if self.enabled:
+            conn.set_trace_callback(lambda statement: self.count("queries"))
+        return conn
+
+    def report(self):
+        with self.lock:
+            return {
+                "finished": datetime.now().isoformat(),
+                "wall_seconds": time.perf_counter() - self.started,
+                "stages": {
+                    name: dict(stage, slowest=[
+                        {"seconds": seconds, "item": item}
+                        for seconds, item in sorted(self.slowest[name], reverse=True)
+                    ])
+                    for name, stage in sorted(self.stages.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def write_report(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        print(f"Stats written to {path}")
+
+
+# Shared by every module, so one report covers the whole pipeline
+stats = Stats()
+
+
+@contextmanager
+def profiled(stats_path=None, profile_path=None):
+    """Collect stats (written as JSON to stats_path) and a cProfile dump of the calling thread (to profile_path).
+
+    Either path may be None to skip it. cProfile only sees the thread that
+    enters this, so work on thread pools shows up in the stage timings only.
+    """
+    if stats_path is not None or profile_path is not None:
+        stats.enable()
+    profiler = cProfile.Profile() if profile_path is not None else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield stats
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            print(f"Profile written to {profile_path}")
+        if stats_path is not None:
+            stats.write_report(stats_path)
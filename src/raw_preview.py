@@ -0,0 +1,184 @@
+import io
+import os
+import struct
+from profiling import stats
+
+TIFF_MAGIC = {42, 0x4F52, 0x5352}  # TIFF, Olympus ORF
+RAF_MAGIC = b"FUJIFILMCCD-RAW "
+
+# Tags used to find previews
+NEW_SUBFILE_TYPE = 0x00FE
+COMPRESSION = 0x0103
+PHOTOMETRIC = 0x0106
+STRIP_OFFSETS = 0x0111
+ORIENTATION = 0x0112
+STRIP_BYTE_COUNTS = 0x0117
+SUB_IFDS = 0x014A
+JPEG_OFFSET = 0x0201
+JPEG_LENGTH = 0x0202
+CR2_SLICE = 0xC640
+
+# Photometric interpretations of sensor data rather than a preview
+RAW_PHOTOMETRIC = {32803, 34892}
+
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 7: 1, 13: 4}
+TYPE_FORMATS = {1: "B", 3: "H", 4: "I", 7: "B", 13: "I"}
+ASCII = 2
+
+MAX_IFDS = 32
+
+# Image.Transpose operations for each EXIF orientation, by name so that
+# reading headers (see exif) doesn't need PIL
+ORIENTATION_TRANSPOSE = {
+    2: "FLIP_LEFT_RIGHT",
+    3: "ROTATE_180",
+    4: "FLIP_TOP_BOTTOM",
+    5: "TRANSPOSE",
+    6: "ROTATE_270",
+    7: "TRANSVERSE",
+    8: "ROTATE_90",
+}
+
+
+def read_ifd(f, offset, endian):
+    """Return {tag: [values]} for the numeric and ASCII entries of the IFD at offset, and the next IFD offset.
+
+    ASCII entries hold a single decoded string, and entries without values
+    are left out, so every list has at least one item. Raises struct.error
+    if the IFD runs past the end of the file.
+    """
+    f.seek(offset)
+    (count,) = struct.unpack(endian + "H", f.read(2))
+    entries = f.read(count * 12)
+    (next_offset,) = struct.unpack(endian + "I", f.read(4) or b"\0\0\0\0")
+
+    tags = {}
+    for i in range(count):
+        tag, value_type, value_count = struct.unpack(
+            endian + "HHI", entries[i * 12 : i * 12 + 8]
+        )
+        if value_type not in TYPE_SIZES or not 0 < value_count <= 1024:
+            continue
+        size = TYPE_SIZES[value_type] * value_count
+        data = entries[i * 12 + 8 : i * 12 + 12]
+        if size > 4:
+            (data_offset,) = struct.unpack(endian + "I", data)
+            position = f.tell()
+            f.seek(data_offset)
+            data = f.read(size)
+            f.seek(position)
+        if value_type == ASCII:
+            tags[tag] = [data[:size].split(b"\0")[0].decode("ascii", "replace")]
+            continue
+        fmt = f"{endian}{value_count}{TYPE_FORMATS[value_type]}"
+        tags[tag] = list(struct.unpack(fmt, data[:size]))
+    return tags, next_offset
+
+
+def numeric_tag(tags, tag):
+    """Return the values of a numeric tag from read_ifd, or [] if it is missing or stored as text."""
+    values = tags.get(tag, [])
+    return values if values and isinstance(values[0], int) else []
+
+
+def find_tiff_previews(f):
+    """Return ([(offset, length), ...], orientation) for the JPEG previews in a TIFF-based RAW file."""
+    f.seek(0)
+    header = f.read(8)
+    endian = {b"II": "<", b"MM": ">"}.get(header[:2])
+    if endian is None or len(header) < 8:
+        return [], 1
+    magic, first_ifd = struct.unpack(endian + "HI", header[2:])
+    if magic not in TIFF_MAGIC:
+        return [], 1
+
+    previews = []
+    orientation = 1
+    pending = [first_ifd]
+    seen = set()
+    while pending and len(seen) < MAX_IFDS:
+        offset = pending.pop(0)
+        if offset == 0 or offset in seen:
+            continue
+        seen.add(offset)
+        try:
+            tags, next_offset = read_ifd(f, offset, endian)
+        except struct.error:
+            continue
+        pending.append(next_offset)
+        pending.extend(numeric_tag(tags, SUB_IFDS))
+
+        if len(seen) == 1 and ORIENTATION in tags:
+            orientation = tags[ORIENTATION][0]
+        compression = tags.get(COMPRESSION, [0])[0]
+        is_sensor_data = (
+            tags.get(PHOTOMETRIC, [0])[0] in RAW_PHOTOMETRIC
+            or CR2_SLICE in tags
+            or tags.get(NEW_SUBFILE_TYPE, [None])[0] == 0 and compression == 7
+        )
+        if numeric_tag(tags, JPEG_OFFSET) and numeric_tag(tags, JPEG_LENGTH):
+            previews.append((tags[JPEG_OFFSET][0], tags[JPEG_LENGTH][0]))
+        elif (
+            compression in (6, 7)
+            and not is_sensor_data
+            and len(numeric_tag(tags, STRIP_OFFSETS)) == 1
+            and numeric_tag(tags, STRIP_BYTE_COUNTS)
+        ):
+            previews.append((tags[STRIP_OFFSETS][0], tags[STRIP_BYTE_COUNTS][0]))
+    return previews, orientation
+
+
+def find_raf_previews(f):
+    """Return ([(offset, length)], 1) for the JPEG preview of a Fujifilm RAF file."""
+    f.seek(0)
+    header = f.read(92)
+    if not header.startswith(RAF_MAGIC) or len(header) < 92:
+        return [], 1
+    offset, length = struct.unpack(">II", header[84:92])
+    return [(offset, length)], 1
+
+
+def extract_preview(file_path):
+    """Return (jpeg_bytes, orientation) for the largest preview embedded in a RAW file, or (None, 1).
+
+    CR2, NEF, ARW and DNG files are TIFF containers whose IFDs point at one
+    or more JPEG previews, and RAF files give the offset of theirs in a fixed
+    header. Only those headers and the chosen preview are read, the RAW data
+    itself is never decoded. ORF files are TIFF containers too, but keep
+    their large preview in the Olympus MakerNote, which isn't parsed, so
+    only their IFD1 thumbnail (about 160x120) is found.
+    """
+    with stats.stage("raw_preview_extract", file_path), open(file_path, "rb") as f:
+        previews, orientation = find_raf_previews(f)
+        if not previews:
+            previews, orientation = find_tiff_previews(f)
+
+        file_size = os.fstat(f.fileno()).st_size
+        for offset, length in sorted(previews, key=lambda p: p[1], reverse=True):
+            if offset + length > file_size:
+                # Corrupt or truncated, don't read (or allocate) past the end
+                continue
+            f.seek(offset)
+            data = f.read(length)
+            stats.count("bytes_read", len(data))
+            if data[:2] == b"\xff\xd8":
+                return data, orientation
+    return None, 1
+
+
+def open_preview(file_path, size=None):
+    """Return the embedded preview of a RAW file as an upright PIL image, or None.
+
+    If size is given, the JPEG is decoded at the smallest scale that still covers it.
+    """
+    from PIL import Image
+
+    data, orientation = extract_preview(file_path)
+    if data is None:
+        return None
+    img = Image.open(io.BytesIO(data))
+    if size is not None:
+        img.draft("RGB", size)
+    if orientation in ORIENTATION_TRANSPOSE:
+        img = img.transpose(getattr(Image.Transpose, ORIENTATION_TRANSPOSE[orientation]))
+    return img
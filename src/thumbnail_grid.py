@@ -0,0 +1,141 @@
+import tkinter as tk
+from tkinter import ttk
+from thumbnails import show_on_label
+
+
+class GridCell:
+    def __init__(self, canvas):
+        self.frame = tk.Frame(canvas, bd=0, relief=tk.FLAT)
+        self.label = tk.Label(self.frame)
+        self.label.pack()
+        self.window_id = canvas.create_window(0, 0, window=self.frame, anchor="nw")
+        self.index = None
+        self.future = None
+
+
+class ThumbnailGrid(ttk.Frame):
+    """Scrollable grid of thumbnails that only creates widgets for the rows in view.
+
+    Cells scrolled out of view are reused for the rows coming into view, and
+    their PhotoImages are dropped, so memory and widget count depend on the
+    visible area rather than the number of files. overscan extra rows above
+    and below the view are kept loaded so slow scrolling doesn't show blanks.
+    """
+
+    def __init__(
+        self,
+        parent,
+        files,
+        thumbnail_loader,
+        size=(150, 150),
+        columns=4,
+        padding=10,
+        overscan=1,
+        height=None,
+        on_click=None,
+        selected=None,
+    ):
+        super().__init__(parent)
+        self.files = files
+        self.thumbnail_loader = thumbnail_loader
+        self.size = size
+        self.columns = columns
+        self.padding = padding
+        self.overscan = overscan
+        self.on_click = on_click
+        self.selected = selected if selected is not None else set()
+        self.cell_width = size[0] + 2 * padding
+        self.cell_height = size[1] + 2 * padding
+        self.rows = (len(files) + columns - 1) // columns
+
+        self.canvas = tk.Canvas(
+            self,
+            width=self.cell_width * columns,
+            height=height or self.cell_height,
+            highlightthickness=0,
+        )
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.canvas.yview)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        # Called by Tk whenever the visible part of the canvas changes
+        def on_scroll(first, last):
+            scrollbar.set(first, last)
+            self.refresh()
+
+        self.canvas.configure(
+            yscrollcommand=on_scroll,
+            scrollregion=(0, 0, self.cell_width * columns, self.cell_height * self.rows),
+        )
+        self.canvas.bind("<Configure>", lambda e: self.refresh())
+        self.bind("<Destroy>", lambda e: self.cancel() if e.widget is self else None)
+
+        self.placeholder = tk.PhotoImage(width=size[0], height=size[1])
+        self.cells = {}
+        self.free_cells = []
+
+    def refresh(self):
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first_row = max(0, int(top // self.cell_height) - self.overscan)
+        last_row = min(self.rows - 1, int(bottom // self.cell_height) + self.overscan)
+        wanted = range(
+            first_row * self.columns,
+            min(len(self.files), (last_row + 1) * self.columns),
+        )
+
+        for index in [index for index in self.cells if index not in wanted]:
+            self.release(self.cells.pop(index))
+        for index in wanted:
+            if index not in self.cells:
+                self.cells[index] = self.assign(index)
+
+    def assign(self, index):
+        cell = self.free_cells.pop() if self.free_cells else GridCell(self.canvas)
+        file_path = self.files[index]
+        cell.index = index
+        row, col = divmod(index, self.columns)
+        self.canvas.coords(
+            cell.window_id,
+            col * self.cell_width + self.padding,
+            row * self.cell_height + self.padding,
+        )
+        self.canvas.itemconfigure(cell.window_id, state="normal")
+
+        cell.label.config(image=self.placeholder)
+        cell.label.image = self.placeholder
+        cell.label.bind("<Button-1>", lambda e: self.click(file_path))
+        self.highlight(cell)
+        cell.future = self.thumbnail_loader.load(
+            file_path,
+            self.size,
+            lambda img: show_on_label(cell.label, img) if cell.index == index else None,
+        )
+        return cell
+
+    def release(self, cell):
+        self.thumbnail_loader.cancel([cell.future])
+        cell.index = None
+        cell.label.config(image=self.placeholder)
+        cell.label.image = self.placeholder
+        self.canvas.itemconfigure(cell.window_id, state="hidden")
+        self.free_cells.append(cell)
+
+    def cancel(self):
+        self.thumbnail_loader.cancel([cell.future for cell in self.cells.values()])
+
+    def click(self, file_path):
+        if self.on_click is not None:
+            self.on_click(file_path)
+        self.update_selection()
+
+    def highlight(self, cell):
+        if self.files[cell.index] in self.selected:
+            cell.frame.config(relief=tk.FLAT, bd=2, bg="white")
+        else:
+            cell.frame.config(relief=tk.FLAT, bd=0)
+
+    def update_selection(self):
+        for cell in self.cells.values():
+            self.highlight(cell)
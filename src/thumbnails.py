@@ -0,0 +1,152 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageTk
+from raw_preview import open_preview
+from utils import raw_extensions, CACHE_DIR
+from profiling import stats
+
+DEFAULT_CACHE_DIR = os.path.join(CACHE_DIR, "thumbnails")
+DEFAULT_MAX_BYTES = 500 * 1024 * 1024
+
+
+class ThumbnailCache:
+    """On-disk cache of JPEG thumbnails, keyed by source path, size, mtime and thumbnail size.
+
+    A changed source file gets a new key, so stale thumbnails are never served;
+    they just age out. Once the cache is over max_bytes, the least recently
+    used thumbnails are removed. Each hit touches the cached file's mtime to
+    record its use.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(cache_dir))
+
+    def cache_path(self, file_path, size):
+        stat = os.stat(file_path)
+        key = f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}|{size[0]}x{size[1]}"
+        return os.path.join(
+            self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".jpg"
+        )
+
+    def get(self, file_path, size):
+        """Return a PIL thumbnail of file_path that fits in size, from the cache if possible."""
+        cache_path = self.cache_path(file_path, size)
+        try:
+            with stats.stage("thumbnail_cache_read"):
+                img = Image.open(cache_path)
+                img.load()
+            os.utime(cache_path)
+            stats.count("thumbnail_cache_hits")
+            return img
+        except OSError:
+            stats.count("thumbnail_cache_misses")
+
+        with stats.stage("thumbnail_decode", file_path):
+            if file_path.lower().endswith(tuple(raw_extensions)):
+                img = open_preview(file_path, size)
+                if img is None:
+                    raise OSError(f"No embedded preview found in {file_path}")
+            else:
+                img = Image.open(file_path)
+                # Lets JPEGs decode straight at a reduced scale
+                img.draft("RGB", size)
+            img.thumbnail(size)
+            img = img.convert("RGB")
+
+        temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        with stats.stage("thumbnail_cache_write"):
+            img.save(temp_path, "JPEG", quality=85)
+            os.replace(temp_path, cache_path)
+        with self.lock:
+            self.total_bytes += os.path.getsize(cache_path)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+        return img
+
+    def evict(self):
+        # Trim to 90% of the cap so eviction doesn't run on every new thumbnail
+        entries = sorted(os.scandir(self.cache_dir), key=lambda e: e.stat().st_mtime)
+        for entry in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                entry_size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.total_bytes -= entry_size
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def load_thumbnail(file_path, size):
+    """Return a thumbnail of file_path that fits in size, using the shared on-disk cache."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ThumbnailCache()
+    return _default_cache.get(file_path, size)
+
+
+class ThumbnailLoader:
+    """Loads thumbnails on a thread pool and hands them back on the Tk main loop.
+
+    PhotoImage objects must be created on the Tk thread, so the workers only
+    decode PIL images. A root.after poll passes finished images to their
+    callbacks, which build the PhotoImage.
+    """
+
+    def __init__(self, root, workers=4, poll_ms=30):
+        self.root = root
+        self.poll_ms = poll_ms
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.results = queue.Queue()
+        self.root.after(self.poll_ms, self.poll)
+
+    def load(self, file_path, size, callback):
+        """Queue file_path for loading, and call callback(img) on the Tk thread once it is ready."""
+        future = self.executor.submit(load_thumbnail, file_path, size)
+        future.add_done_callback(
+            lambda f: None if f.cancelled() else self.results.put((f, callback))
+        )
+        return future
+
+    def cancel(self, futures):
+        """Drop thumbnails that have not started loading yet."""
+        for future in futures:
+            future.cancel()
+
+    def poll(self):
+        # Bound the work done per tick so the UI stays responsive
+        deadline = time.monotonic() + 0.02
+        while time.monotonic() < deadline:
+            try:
+                future, callback = self.results.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                img = future.result()
+            except Exception as e:
+                print(f"Could not load thumbnail: {e}")
+                continue
+            callback(img)
+        self.root.after(self.poll_ms, self.poll)
+
+
+def show_on_label(label, img):
+    """Put a loaded thumbnail on label, unless the label was destroyed while it loaded."""
+    if label.winfo_exists():
+        with stats.stage("photoimage"):
+            photo = ImageTk.PhotoImage(img)
+        label.config(image=photo)
+        label.image = photo
@@ -1,8 +1,18 @@
 import os
 import hashlib
-from datetime import datetime
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import combinations
+from datetime import datetime, timedelta
 from itertools import groupby
+from collections import defaultdict
+from contextlib import closing, contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import sqlite3
+from profiling import stats
+from io_scheduler import IOScheduler, device_read_size, locality_order
 
 raw_extensions = {
     ".cr2",
@@ -13,6 +23,510 @@ raw_extensions = {
     ".raf",
 }
 
+# Per-user caches (thumbnails, card metadata) live here
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "dslr-camera-importer")
+
+# Concurrent reads that keep a USB card reader busy without making it seek back and forth
+CARD_READER_WORKERS = 4
+
+# Bytes read from each end of a file for its fingerprint
+FINGERPRINT_BYTES = 256 * 1024
+
+# Keeps IN (...) lists well under SQLite's bound parameter limit
+SQLITE_MAX_PARAMS = 500
+
+# Bytes of each database the app's shared reader maps into memory
+READER_MMAP_SIZE = 256 * 1024 * 1024
+
+SCHEMA_VERSION = 5
+
+# Content hash algorithms, by the name recorded in photo_index.hash_algorithm
+HASH_ALGORITHMS = {
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "blake2b": lambda: hashlib.blake2b(digest_size=32),
+}
+try:
+    import blake3
+
+    HASH_ALGORITHMS["blake3"] = blake3.blake3
+except ImportError:
+    pass
+try:
+    import xxhash
+
+    HASH_ALGORITHMS["xxh3_128"] = xxhash.xxh3_128
+except ImportError:
+    pass
+
+# Used for new databases; databases indexed before hash_algorithm was recorded keep md5
+DEFAULT_HASH_ALGORITHM = "blake2b"
+
+# 64-bit perceptual hashes are searched as 4 bands of 16 bits, each with its
+# own index: two hashes within distance d share a band within d // 4 bits
+PERCEPTUAL_BANDS = 4
+PERCEPTUAL_BAND_BITS = 16
+# Bits two perceptual hashes may differ by and still count as the same photo
+DEFAULT_PERCEPTUAL_DISTANCE = 6
+
+# Folder of a photo_index row, with its trailing separator, for either separator
+FOLDER_PATH_SQL = "rtrim(filepath, replace(replace(filepath, '/', ''), '\\', ''))"
+# EXIF capture time of a row, or its mtime for rows indexed before it was stored
+CAPTURE_TIME_SQL = "COALESCE(capture_time, creation_time)"
+CAPTURE_DATE_SQL = f"substr({CAPTURE_TIME_SQL}, 1, 10)"
+
+
+def create_photo_index_table(cursor):
+    """Create the photo_index table, adding any columns missing from older databases."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS photo_index (
+            id INTEGER PRIMARY KEY,
+            filepath TEXT,
+            folder TEXT,
+            filename TEXT,
+            md5_hash TEXT UNIQUE,
+            creation_time TEXT,
+            file_size INTEGER,
+            mtime REAL,
+            fingerprint TEXT,
+            content_hash TEXT,
+            hash_algorithm TEXT
+        )
+    """
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS index_meta (key TEXT PRIMARY KEY, value TEXT)"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS library_roots (name TEXT PRIMARY KEY, path TEXT NOT NULL)"
+    )
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(photo_index)")}
+    for name, column_type in (
+        ("file_size", "INTEGER"),
+        ("mtime", "REAL"),
+        ("fingerprint", "TEXT"),
+        ("content_hash", "TEXT"),
+        ("hash_algorithm", "TEXT"),
+        ("root", "TEXT"),
+        ("relative_path", "TEXT"),
+        ("perceptual_hash", "INTEGER"),
+        ("capture_time", "TEXT"),
+    ):
+        if name not in columns:
+            cursor.execute(f"ALTER TABLE photo_index ADD COLUMN {name} {column_type}")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_md5 ON photo_index (md5_hash)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_filepath ON photo_index (filepath)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_filename ON photo_index (filename)")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_fingerprint ON photo_index (fingerprint, file_size)"
+    )
+    cursor.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_content_hash
+        ON photo_index (content_hash, hash_algorithm)
+    """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_root_path ON photo_index (root, relative_path)"
+    )
+    for band in range(PERCEPTUAL_BANDS):
+        cursor.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS idx_perceptual_band{band}
+            ON photo_index ({perceptual_band_sql(band)})
+            WHERE perceptual_hash IS NOT NULL
+        """
+        )
+
+    if get_index_meta(cursor, "schema_version", 1) < 2:
+        # md5_hash was the only identity column before version 2
+        cursor.execute(
+            """
+            UPDATE photo_index SET content_hash = md5_hash, hash_algorithm = 'md5'
+            WHERE md5_hash IS NOT NULL AND content_hash IS NULL
+        """
+        )
+        if get_index_meta(cursor, "hash_algorithm") is None:
+            cursor.execute("SELECT 1 FROM photo_index WHERE md5_hash IS NOT NULL LIMIT 1")
+            legacy = cursor.fetchone() is not None
+            set_index_meta(
+                cursor, "hash_algorithm", "md5" if legacy else DEFAULT_HASH_ALGORITHM
+            )
+    if get_index_meta(cursor, "schema_version", 1) == 4:
+        # Dates were keyed on creation_time alone; recreated below on CAPTURE_DATE_SQL
+        cursor.execute("DROP INDEX IF EXISTS idx_capture_date")
+        for trigger in ("summary_insert", "summary_update", "summary_delete"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    create_summary_tables(cursor)
+    if get_index_meta(cursor, "schema_version", 1) < 4:
+        # Summaries are built once for existing rows, then kept current by triggers
+        cursor.execute(
+            f"INSERT OR IGNORE INTO summary_dirty SELECT DISTINCT 'folder', {FOLDER_PATH_SQL} FROM photo_index"
+        )
+        cursor.execute(
+            f"""
+            INSERT OR IGNORE INTO summary_dirty SELECT DISTINCT 'date', {CAPTURE_DATE_SQL} FROM photo_index
+            WHERE {CAPTURE_DATE_SQL} IS NOT NULL
+        """
+        )
+        refresh_summaries(cursor)
+    if get_index_meta(cursor, "schema_version", 1) < SCHEMA_VERSION:
+        # Version 3 only adds library roots, which start out empty, and version
+        # 5 capture_time, which index and import runs fill in
+        set_index_meta(cursor, "schema_version", SCHEMA_VERSION)
+
+
+def create_summary_tables(cursor):
+    """Create folder_summary and date_summary, and the triggers that mark their rows stale.
+
+    Each summary row holds the file count, total size, capture time range and
+    a filename sketch (see pack_filename_keys) of the photo_index rows in one
+    folder or taken on one date. Any insert, update or delete on photo_index
+    records the folders and dates it touched in summary_dirty, and
+    refresh_summaries rebuilds just those rows, so writers never need to
+    track what they changed.
+    """
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS folder_summary (
+            folder_path TEXT PRIMARY KEY,
+            folder TEXT,
+            file_count INTEGER,
+            total_size INTEGER,
+            first_capture TEXT,
+            last_capture TEXT,
+            filename_keys BLOB
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS date_summary (
+            capture_date TEXT PRIMARY KEY,
+            file_count INTEGER,
+            total_size INTEGER,
+            first_capture TEXT,
+            last_capture TEXT,
+            filename_keys BLOB
+        )
+    """
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS summary_dirty (kind TEXT, key TEXT, PRIMARY KEY (kind, key))"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_folder_summary_folder ON folder_summary (folder)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_folder_summary_capture ON folder_summary (first_capture, last_capture)"
+    )
+    cursor.execute(
+        f"CREATE INDEX IF NOT EXISTS idx_folder_path ON photo_index ({FOLDER_PATH_SQL})"
+    )
+    cursor.execute(
+        f"CREATE INDEX IF NOT EXISTS idx_capture_date ON photo_index ({CAPTURE_DATE_SQL})"
+    )
+
+    def mark_dirty(row):
+        folder_path = FOLDER_PATH_SQL.replace("filepath", f"{row}.filepath")
+        capture_date = CAPTURE_DATE_SQL.replace(
+            "capture_time", f"{row}.capture_time"
+        ).replace("creation_time", f"{row}.creation_time")
+        return f"""
+            INSERT OR IGNORE INTO summary_dirty SELECT 'folder', {folder_path};
+            INSERT OR IGNORE INTO summary_dirty
+            SELECT 'date', {capture_date} WHERE {capture_date} IS NOT NULL;
+        """
+
+    cursor.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS summary_insert AFTER INSERT ON photo_index
+        BEGIN {mark_dirty("new")} END
+    """
+    )
+    cursor.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS summary_update
+        AFTER UPDATE OF filepath, filename, creation_time, capture_time, file_size ON photo_index
+        BEGIN {mark_dirty("old")} {mark_dirty("new")} END
+    """
+    )
+    cursor.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS summary_delete AFTER DELETE ON photo_index
+        BEGIN {mark_dirty("old")} END
+    """
+    )
+
+
+def filename_key(filename):
+    """Return a stable signed 64-bit key for a filename, as stored in filename sketches."""
+    digest = hashlib.blake2b(filename.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def pack_filename_keys(filenames):
+    """Return the sorted filename_key of each of filenames as a little-endian BLOB, 8 bytes per file."""
+    keys = array("q", sorted({filename_key(filename) for filename in filenames}))
+    if sys.byteorder != "little":
+        keys.byteswap()
+    return keys.tobytes()
+
+
+def unpack_filename_keys(blob):
+    keys = array("q")
+    keys.frombytes(blob or b"")
+    if sys.byteorder != "little":
+        keys.byteswap()
+    return keys
+
+
+def refresh_summaries(cursor):
+    """Rebuild the folder_summary and date_summary rows marked stale in summary_dirty.
+
+    Each stale row is rebuilt with one indexed query over its photo_index
+    rows. Called by writers before they commit; readers only read the tables.
+    """
+    cursor.execute("SELECT kind, key FROM summary_dirty")
+    dirty = cursor.fetchall()
+    if not dirty:
+        return
+    with stats.stage("summary_refresh"):
+        for kind, key in dirty:
+            if kind == "folder":
+                cursor.execute(
+                    f"""
+                    SELECT filename, file_size, {CAPTURE_TIME_SQL} FROM photo_index
+                    WHERE {FOLDER_PATH_SQL} = ?
+                """,
+                    (key,),
+                )
+            else:
+                cursor.execute(
+                    f"""
+                    SELECT filename, file_size, {CAPTURE_TIME_SQL} FROM photo_index
+                    WHERE {CAPTURE_DATE_SQL} = ?
+                """,
+                    (key,),
+                )
+            rows = cursor.fetchall()
+            table, key_column = (
+                ("folder_summary", "folder_path")
+                if kind == "folder"
+                else ("date_summary", "capture_date")
+            )
+            if not rows:
+                cursor.execute(f"DELETE FROM {table} WHERE {key_column} = ?", (key,))
+                continue
+            capture_times = [row[2] for row in rows if row[2] is not None]
+            summary = (
+                len(rows),
+                sum(row[1] or 0 for row in rows),
+                min(capture_times, default=None),
+                max(capture_times, default=None),
+                pack_filename_keys(row[0] for row in rows),
+            )
+            if kind == "folder":
+                folder = os.path.basename(key.rstrip("/\\"))
+                cursor.execute(
+                    "INSERT OR REPLACE INTO folder_summary VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, folder) + summary,
+                )
+            else:
+                cursor.execute(
+                    "INSERT OR REPLACE INTO date_summary VALUES (?, ?, ?, ?, ?, ?)",
+                    (key,) + summary,
+                )
+        cursor.execute("DELETE FROM summary_dirty")
+    stats.count("summary_rows_refreshed", len(dirty))
+
+
+def perceptual_band_sql(band):
+    """SQL for one band of perceptual_hash. Queries must use the same text for SQLite to use the band's index."""
+    shift = band * PERCEPTUAL_BAND_BITS
+    return f"((perceptual_hash >> {shift}) & {(1 << PERCEPTUAL_BAND_BITS) - 1})"
+
+
+def to_perceptual_column(value):
+    """Return an unsigned 64-bit perceptual hash as the signed integer SQLite stores."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def configure_bulk_writes(conn):
+    """Tune a connection for long write-heavy runs such as indexing.
+
+    WAL lets the GUI keep reading while the index is written, and with WAL
+    synchronous=NORMAL only syncs at checkpoints rather than every commit.
+    """
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA cache_size = -65536")  # 64 MB
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+
+def get_index_meta(cursor, key, default=None):
+    cursor.execute("SELECT value FROM index_meta WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    if row is None:
+        return default
+    return type(default)(row[0]) if default is not None else row[0]
+
+
+def set_index_meta(cursor, key, value):
+    cursor.execute(
+        "INSERT OR REPLACE INTO index_meta (key, value) VALUES (?, ?)", (key, str(value))
+    )
+
+
+def get_hash_algorithm(cursor):
+    """Return the content hash algorithm new hashes in this database are computed with."""
+    return get_index_meta(cursor, "hash_algorithm", DEFAULT_HASH_ALGORITHM)
+
+
+def set_hash_algorithm(cursor, algorithm):
+    """Switch the database to another hash algorithm.
+
+    Existing rows keep their hash until they are next compared, when it is
+    recomputed with the new algorithm.
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(
+            f"Unknown hash algorithm {algorithm}, must be one of {sorted(HASH_ALGORITHMS)}"
+        )
+    set_index_meta(cursor, "hash_algorithm", algorithm)
+
+
+def get_library_roots(cursor):
+    """Return {root name: absolute path ending in a separator} for the library roots of the database."""
+    cursor.execute("SELECT name, path FROM library_roots")
+    return dict(cursor.fetchall())
+
+
+def set_library_root(cursor, name, path):
+    """Add a named library root, or move an existing root to a new path.
+
+    Rows under path that don't belong to a root yet are assigned to this one.
+    Rows keep their path relative to the root, with / separators, so when a
+    drive is mounted somewhere else only the root's path has to change: the
+    absolute filepath of each of its rows is rebuilt from it here.
+    """
+    prefix = os.path.join(os.path.abspath(path), "")
+    cursor.execute(
+        "INSERT OR REPLACE INTO library_roots (name, path) VALUES (?, ?)", (name, prefix)
+    )
+    cursor.execute(
+        """
+        UPDATE photo_index SET filepath = ? || replace(relative_path, '/', ?)
+        WHERE root = ?
+    """,
+        (prefix, os.sep, name),
+    )
+    cursor.execute(
+        """
+        UPDATE photo_index
+        SET root = ?, relative_path = replace(substr(filepath, length(?) + 1), ?, '/')
+        WHERE root IS NULL AND filepath >= ? AND filepath < ?
+    """,
+        (name, prefix, os.sep, *path_prefix_range(prefix)),
+    )
+
+
+def path_prefix_range(directory):
+    """Return (low, high) bounds such that low <= filepath < high for paths under directory.
+
+    Unlike comparing a substr of filepath, the range can use idx_filepath.
+    """
+    prefix = os.path.join(os.path.abspath(directory), "")
+    # The separator is the prefix's last character; the next one sorts after
+    # every path that continues with it
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def locate_in_roots(roots, file_path):
+    """Return (root name, path relative to it) for the innermost of roots containing file_path, or (None, None)."""
+    best = (None, None)
+    best_length = 0
+    for name, prefix in roots.items():
+        if file_path.startswith(prefix) and len(prefix) > best_length:
+            best = (name, file_path[len(prefix) :].replace(os.sep, "/"))
+            best_length = len(prefix)
+    return best
+
+
+def write_batch_to_db(cursor, batch_data, roots=None):
+    """Write batch data to the database, skipping files whose content is already indexed.
+
+    Rows under one of the library roots (looked up if roots isn't given) are
+    recorded against it.
+    """
+    if roots is None:
+        roots = get_library_roots(cursor)
+    with stats.stage("sqlite_write"):
+        cursor.executemany(
+            """
+            INSERT OR IGNORE INTO photo_index (filepath, folder, filename, content_hash, hash_algorithm, creation_time, file_size, mtime, fingerprint, perceptual_hash, capture_time, root, relative_path)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+            [row + locate_in_roots(roots, row[0]) for row in batch_data],
+        )
+    # rowcount, unlike total_changes, leaves out rows written by the summary triggers
+    ignored = len(batch_data) - max(cursor.rowcount, 0)
+    if ignored:
+        print(f"Skipped {ignored} files already in the index")
+
+
+def load_indexed_files(cursor, directory, algorithm):
+    """Return {filepath: (file_size, mtime, content_hash, fingerprint, perceptual_hash, capture_time)} for indexed files under directory.
+
+    content_hash is None for rows hashed with an algorithm other than `algorithm`.
+    """
+    cursor.execute(
+        """
+        SELECT filepath, file_size, mtime,
+            CASE WHEN hash_algorithm = ? THEN content_hash END, fingerprint, perceptual_hash,
+            capture_time
+        FROM photo_index
+        WHERE filepath >= ? AND filepath < ?
+    """,
+        (algorithm, *path_prefix_range(directory)),
+    )
+    return {row[0]: row[1:] for row in cursor.fetchall()}
+
+
+def remove_duplicate_paths(cursor, directory):
+    """Delete all but one photo_index row for each filepath under directory that has several, returning the paths.
+
+    Such rows are left by a run without --incremental over a file edited in
+    place. The row kept is the one matching the file's current size and
+    mtime, or the newest if none does.
+    """
+    cursor.execute(
+        """
+        SELECT filepath FROM photo_index
+        WHERE filepath >= ? AND filepath < ?
+        GROUP BY filepath HAVING COUNT(*) > 1
+    """,
+        path_prefix_range(directory),
+    )
+    paths = [row[0] for row in cursor.fetchall()]
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            current = (stat.st_size, stat.st_mtime)
+        except OSError:
+            current = None
+        cursor.execute(
+            "SELECT id, file_size, mtime FROM photo_index WHERE filepath = ? ORDER BY id DESC",
+            (path,),
+        )
+        rows = cursor.fetchall()
+        keep = next((row[0] for row in rows if tuple(row[1:]) == current), rows[0][0])
+        cursor.execute(
+            "DELETE FROM photo_index WHERE filepath = ? AND id != ?", (path, keep)
+        )
+    return paths
+
 
 def get_file_creation_time(file_path):
     """Get the file creation datetime."""
@@ -20,13 +534,209 @@ def get_file_creation_time(file_path):
     return datetime.fromtimestamp(timestamp)
 
 
+def compute_hash(file_path, algorithm="md5", read_size=None):
+    """Compute the content hash of a file with one of HASH_ALGORITHMS.
+
+    Reads are read_size bytes, by default the size that suits the file's device.
+    """
+    if read_size is None:
+        read_size = device_read_size(file_path)
+    content_hash = HASH_ALGORITHMS[algorithm]()
+    buffer = bytearray(read_size)
+    view = memoryview(buffer)
+    with stats.stage("hash", file_path), open(file_path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            content_hash.update(view[:n])
+            stats.count("bytes_read", n)
+    return content_hash.hexdigest()
+
+
 def compute_md5(file_path):
     """Compute the MD5 hash of a file."""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    return compute_hash(file_path, "md5")
+
+
+def compute_fingerprint(file_path, file_size=None):
+    """Compute a cheap fingerprint from the file size and its first and last FINGERPRINT_BYTES.
+
+    Files with different fingerprints cannot have the same content, so the full
+    hash only has to be computed when two fingerprints collide.
+    """
+    if file_size is None:
+        file_size = os.path.getsize(file_path)
+    hash_blake2 = hashlib.blake2b(digest_size=16)
+    with stats.stage("fingerprint", file_path), open(file_path, "rb") as f:
+        data = f.read(FINGERPRINT_BYTES)
+        hash_blake2.update(data)
+        stats.count("bytes_read", len(data))
+        if file_size > FINGERPRINT_BYTES:
+            f.seek(max(FINGERPRINT_BYTES, file_size - FINGERPRINT_BYTES))
+            data = f.read(FINGERPRINT_BYTES)
+            hash_blake2.update(data)
+            stats.count("bytes_read", len(data))
+    return f"{file_size}:{hash_blake2.hexdigest()}"
+
+
+def chunked(items, size=SQLITE_MAX_PARAMS):
+    """Split items into lists small enough to bind as SQL parameters."""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def fingerprint_legacy_rows(cursor, file_sizes):
+    """Fingerprint indexed rows of the given sizes that were indexed before fingerprints were stored.
+
+    Each of them is only read once. Returns (id, filepath, content_hash,
+    hash_algorithm, file_size) for rows whose file can no longer be read, so
+    they can still be compared by their stored hash.
+    """
+    unreadable = {}
+    for chunk in chunked(sorted(file_sizes)):
+        placeholders = ",".join("?" * len(chunk))
+        cursor.execute(
+            f"""
+            SELECT id, filepath, content_hash, hash_algorithm, file_size FROM photo_index
+            WHERE fingerprint IS NULL AND (file_size IN ({placeholders}) OR file_size IS NULL)
+        """,
+            chunk,
+        )
+        for row in cursor.fetchall():
+            row_id, filepath, content_hash = row[:3]
+            try:
+                row_size = os.path.getsize(filepath)
+                row_fingerprint = compute_fingerprint(filepath, row_size)
+            except OSError:
+                if content_hash is not None:
+                    unreadable[row_id] = row
+                continue
+            cursor.execute(
+                "UPDATE photo_index SET fingerprint = ?, file_size = ? WHERE id = ?",
+                (row_fingerprint, row_size, row_id),
+            )
+    return list(unreadable.values())
+
+
+def find_fingerprint_matches(cursor, fingerprint, file_size):
+    """Return (id, filepath, content_hash, hash_algorithm) for indexed rows that may have the same content."""
+    unreadable = fingerprint_legacy_rows(cursor, [file_size])
+    with stats.stage("sqlite_lookup"):
+        cursor.execute(
+            """
+            SELECT id, filepath, content_hash, hash_algorithm FROM photo_index
+            WHERE fingerprint = ?
+        """,
+            (fingerprint,),
+        )
+        rows = cursor.fetchall()
+    return rows + [row[:4] for row in unreadable]
+
+
+def ensure_hash(cursor, row_id, filepath, content_hash, hash_algorithm, algorithm):
+    """Return (hash, algorithm, row) for an indexed row, hashing its file if needed.
+
+    Rows that only have a fingerprint, or were hashed with another algorithm,
+    are rehashed with `algorithm` and updated. If the file can no longer be
+    read, the stored hash (possibly None) is returned as is. row is the
+    (id, filepath, content_hash, hash_algorithm) of the row holding the hash:
+    if another row already has it, this row was a duplicate of that one and
+    is removed.
+    """
+    row = (row_id, filepath, content_hash, hash_algorithm)
+    if content_hash is None or hash_algorithm != algorithm:
+        try:
+            new_hash = compute_hash(filepath, algorithm)
+        except OSError:
+            return content_hash, hash_algorithm, row
+        try:
+            cursor.execute(
+                "UPDATE photo_index SET content_hash = ?, hash_algorithm = ? WHERE id = ?",
+                (new_hash, algorithm, row_id),
+            )
+        except sqlite3.IntegrityError:
+            # Indexed on its fingerprint alone, as a second copy of a file
+            # that has a row already
+            cursor.execute(
+                "SELECT id, filepath FROM photo_index WHERE content_hash = ? AND hash_algorithm = ?",
+                (new_hash, algorithm),
+            )
+            existing_id, existing_path = cursor.fetchone()
+            cursor.execute("DELETE FROM photo_index WHERE id = ?", (row_id,))
+            return new_hash, algorithm, (existing_id, existing_path, new_hash, algorithm)
+        return new_hash, algorithm, (row_id, filepath, new_hash, algorithm)
+    return content_hash, hash_algorithm, row
+
+
+def find_same_content(cursor, file_path, matches, algorithm, file_hashes=None):
+    """Return the first of the find_fingerprint_matches rows with the same content as file_path, or None.
+
+    file_hashes maps algorithm to the hash of file_path, and is filled in as
+    hashes are computed so the caller can reuse them. The row returned is the
+    one left in photo_index, in case ensure_hash removed a duplicate.
+    """
+    if file_hashes is None:
+        file_hashes = {}
+    for match in matches:
+        row_hash, row_algorithm, row = ensure_hash(cursor, *match, algorithm)
+        if row_hash is None:
+            continue
+        if row_algorithm not in file_hashes:
+            file_hashes[row_algorithm] = compute_hash(file_path, row_algorithm)
+        if file_hashes[row_algorithm] == row_hash:
+            return row
+    return None
+
+
+def band_neighbours(value, radius):
+    """Return value and every PERCEPTUAL_BAND_BITS-bit value within radius bits of it."""
+    values = [value]
+    for distance in range(1, radius + 1):
+        for bits in combinations(range(PERCEPTUAL_BAND_BITS), distance):
+            flipped = value
+            for bit in bits:
+                flipped ^= 1 << bit
+            values.append(flipped)
+    return values
+
+
+def find_similar_images(cursor, perceptual_hash, max_distance=DEFAULT_PERCEPTUAL_DISTANCE):
+    """Return [(distance, id, filepath)] for indexed photos whose perceptual hash is within max_distance bits, closest first.
+
+    Uses multi-index hashing: if two hashes differ in at most max_distance
+    bits, at least one of their PERCEPTUAL_BANDS bands differs in at most
+    max_distance // PERCEPTUAL_BANDS bits. Each band's neighbours are looked
+    up in its index, and only those candidates are compared in full, so a
+    lookup touches a handful of rows however large the library is.
+    """
+    unsigned = perceptual_hash & ((1 << 64) - 1)
+    radius = max_distance // PERCEPTUAL_BANDS
+    candidates = {}
+    with stats.stage("perceptual_lookup"):
+        for band in range(PERCEPTUAL_BANDS):
+            band_value = (unsigned >> (band * PERCEPTUAL_BAND_BITS)) & (
+                (1 << PERCEPTUAL_BAND_BITS) - 1
+            )
+            for chunk in chunked(band_neighbours(band_value, radius)):
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(
+                    f"""
+                    SELECT id, filepath, perceptual_hash FROM photo_index
+                    WHERE perceptual_hash IS NOT NULL AND {perceptual_band_sql(band)} IN ({placeholders})
+                """,
+                    chunk,
+                )
+                for row_id, filepath, row_hash in cursor.fetchall():
+                    candidates[row_id] = (filepath, row_hash)
+
+    similar = []
+    for row_id, (filepath, row_hash) in candidates.items():
+        distance = bin((row_hash ^ perceptual_hash) & ((1 << 64) - 1)).count("1")
+        if distance <= max_distance:
+            similar.append((distance, row_id, filepath))
+    return sorted(similar)
 
 
 def is_image_unique_by_name(file_path, cursor):
@@ -40,15 +750,231 @@ def is_image_unique_by_name(file_path, cursor):
         return False
 
 
-def is_image_unique_by_md5(file_path, cursor):
-    md5_hash = compute_md5(file_path)
-
-    # Check if the MD5 hash already exists
-    cursor.execute("SELECT 1 FROM photo_index WHERE md5_hash = ?", (md5_hash,))
-    if cursor.fetchone() is None:
+def is_image_unique_by_hash(file_path, cursor):
+    # Only read the whole file if its fingerprint matches something in the index
+    file_size = os.path.getsize(file_path)
+    matches = find_fingerprint_matches(
+        cursor, compute_fingerprint(file_path, file_size), file_size
+    )
+    if not matches:
         return True
-    else:
-        return False
+
+    algorithm = get_hash_algorithm(cursor)
+    return find_same_content(cursor, file_path, matches, algorithm) is None
+
+
+# Kept for callers written before the hash algorithm was configurable
+is_image_unique_by_md5 = is_image_unique_by_hash
+
+
+def shard_paths(db_path):
+    """Return the index databases to read: db_path itself, or each of them if it is a list of shards."""
+    return [db_path] if isinstance(db_path, str) else list(db_path)
+
+
+def attach_shards(conn, databases):
+    """Attach more index databases to conn and create the temp view all_photo_index across all of them.
+
+    The library can then be split into several databases, for example one
+    per drive or year, that are each indexed and vacuumed on their own but
+    queried together. all_photo_index has a shard column with the schema
+    name each row comes from. SQLite attaches at most 10 databases by default.
+    """
+    schemas = ["main"]
+    for number, database in enumerate(databases, 1):
+        schema = f"shard{number}"
+        conn.execute(f"ATTACH DATABASE ? AS {schema}", (database,))
+        schemas.append(schema)
+    columns = "filepath, folder, filename, content_hash, hash_algorithm, file_size, mtime, fingerprint, root, relative_path"
+    conn.execute("DROP VIEW IF EXISTS temp.all_photo_index")
+    conn.execute(
+        "CREATE TEMP VIEW all_photo_index AS "
+        + " UNION ALL ".join(
+            f"SELECT '{schema}' AS shard, {columns} FROM {schema}.photo_index"
+            for schema in schemas
+        )
+    )
+
+
+class IndexReader:
+    """One read-only connection to the index and its shards, shared by every lookup of an app session.
+
+    The connection is opened on first use, after each shard has been brought
+    up to the current schema, and is then kept open: SQLite's page cache and
+    memory-mapped I/O stay warm between lookups, and nothing is prepared or
+    migrated again. query_only guards against writes from the lookups, and
+    they take turns on the connection through the lock.
+    """
+
+    def __init__(self, db_path):
+        self.databases = shard_paths(db_path)
+        self.schemas = ["main"] + [f"shard{number}" for number in range(1, len(self.databases))]
+        self.lock = threading.RLock()
+        self.conn = None
+
+    def connect(self):
+        with self.lock:
+            if self.conn is None:
+                for database in self.databases:
+                    with closing(sqlite3.connect(database)) as conn:
+                        create_photo_index_table(conn.cursor())
+                        conn.commit()
+                conn = sqlite3.connect(self.databases[0], check_same_thread=False)
+                stats.trace_queries(conn)
+                if len(self.databases) > 1:
+                    attach_shards(conn, self.databases[1:])
+                for schema in self.schemas:
+                    conn.execute(f"PRAGMA {schema}.mmap_size = {READER_MMAP_SIZE}")
+                conn.execute("PRAGMA query_only = ON")
+                self.conn = conn
+            return self.conn
+
+    @contextmanager
+    def cursor(self):
+        with self.lock:
+            yield self.connect().cursor()
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+def shard_cursors(db_path, reader=None):
+    """Yield (cursor, schema) for each shard of db_path.
+
+    With an IndexReader every shard is read through its shared connection,
+    otherwise each one is opened (and its schema brought up to date) in turn.
+    """
+    if reader is not None:
+        with reader.cursor() as cursor:
+            for schema in reader.schemas:
+                yield cursor, schema
+        return
+    for shard in shard_paths(db_path):
+        with closing(stats.trace_queries(sqlite3.connect(shard))) as conn:
+            cursor = conn.cursor()
+            create_photo_index_table(cursor)
+            conn.commit()
+            yield cursor, "main"
+
+
+def find_indexed_filenames(cursor, file_paths, table="photo_index"):
+    """Return the subset of file_paths whose filename is already in table (photo_index or all_photo_index)."""
+    filenames = {os.path.basename(file_path) for file_path in file_paths}
+    found = set()
+    for chunk in chunked(filenames):
+        placeholders = ",".join("?" * len(chunk))
+        with stats.stage("sqlite_lookup"):
+            cursor.execute(
+                f"SELECT DISTINCT filename FROM {table} WHERE filename IN ({placeholders})",
+                chunk,
+            )
+            found.update(row[0] for row in cursor.fetchall())
+    return {
+        file_path for file_path in file_paths if os.path.basename(file_path) in found
+    }
+
+
+def find_indexed_contents(cursor, file_paths):
+    """Return the subset of file_paths whose content is already in photo_index.
+
+    All fingerprints are looked up together, and only files whose fingerprint
+    matches an indexed row are read in full.
+    """
+    # Card files are fingerprinted in parallel, as many at once as their device suits
+    def fingerprint(file_path, stat, read_size):
+        return compute_fingerprint(file_path, stat.st_size), stat.st_size
+
+    with IOScheduler() as scheduler:
+        futures = {
+            file_path: scheduler.submit(fingerprint, file_path, stat, stat=stat)
+            for file_path, stat in locality_order(
+                [(file_path, os.stat(file_path)) for file_path in file_paths]
+            )
+        }
+        fingerprints = {file_path: future.result() for file_path, future in futures.items()}
+    unreadable = fingerprint_legacy_rows(
+        cursor, {file_size for _, file_size in fingerprints.values()}
+    )
+
+    matches = defaultdict(list)
+    for chunk in chunked({fingerprint for fingerprint, _ in fingerprints.values()}):
+        placeholders = ",".join("?" * len(chunk))
+        cursor.execute(
+            f"""
+            SELECT fingerprint, id, filepath, content_hash, hash_algorithm FROM photo_index
+            WHERE fingerprint IN ({placeholders})
+        """,
+            chunk,
+        )
+        for row in cursor.fetchall():
+            matches[row[0]].append(row[1:])
+
+    algorithm = get_hash_algorithm(cursor)
+    existing = set()
+    for file_path, (fingerprint, file_size) in fingerprints.items():
+        candidates = matches[fingerprint] + [
+            row[:4] for row in unreadable if row[4] in (file_size, None)
+        ]
+        if candidates and find_same_content(cursor, file_path, candidates, algorithm):
+            existing.add(file_path)
+    return existing
+
+
+def list_folder(folder, extensions=raw_extensions):
+    """Return ([(file_path, stat), ...], subfolders) for one folder.
+
+    Only files matching extensions are returned (all files if it is empty),
+    with stat taken from the os.scandir entry.
+    """
+    files = []
+    subfolders = []
+    try:
+        with stats.stage("walk", folder), os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subfolders.append(entry.path)
+                    elif entry.is_file() and (
+                        not extensions
+                        or any(entry.name.lower().endswith(ext) for ext in extensions)
+                    ):
+                        files.append((entry.path, entry.stat()))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return files, subfolders
+
+
+def walk_files(directory, extensions=raw_extensions):
+    """Yield (folder, files, folders_left) for each folder under directory as soon as it is listed.
+
+    files is as returned by list_folder. folders_left is the number of folders
+    found but not yet listed, for estimating progress while the walk is running.
+    """
+    stack = [os.path.abspath(directory)]
+    while stack:
+        folder = stack.pop()
+        files, subfolders = list_folder(folder, extensions)
+        # Visit subfolders in listing order, like os.walk
+        stack.extend(reversed(subfolders))
+        yield folder, files, len(stack)
+
+
+def walk_files_parallel(directory, extensions=raw_extensions, workers=CARD_READER_WORKERS):
+    """Like walk_files, but lists up to `workers` folders at once and yields them as they finish."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(list_folder, os.path.abspath(directory), extensions)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subfolders = future.result()
+                for subfolder in subfolders:
+                    pending.add(executor.submit(list_folder, subfolder, extensions))
+                yield files, len(pending)
 
 
 def group_by_date(contents):
@@ -62,36 +988,292 @@ def group_by_date(contents):
     return grouped_contents
 
 
+def iter_photo_metadata(sd_card_directory, file_type_set=set()):
+    """Yield {filepath: modified time} for each folder of the card, including DCIM subfolders, as it is listed."""
+    if not os.path.isdir(sd_card_directory):
+        print("Directory not found.")
+        return
+    for files, _ in walk_files_parallel(sd_card_directory, file_type_set):
+        if files:
+            yield {
+                file_path: datetime.fromtimestamp(stat.st_mtime)
+                for file_path, stat in files
+            }
+
+
 def import_photo_metadata(sd_card_directory, file_type_set=set()):
     contents = {}
-    try:
-        for filename in os.listdir(sd_card_directory):
-            filepath = os.path.join(sd_card_directory, filename)
-            if len(file_type_set) == 0 or any(
-                filename.lower().endswith(ext) for ext in file_type_set
-            ):
-                if os.path.isfile(filepath):  # Check if it's a file
-                    contents[filepath] = get_file_creation_time(filepath)
-    except FileNotFoundError:
-        print("Directory not found.")
+    for folder_contents in iter_photo_metadata(sd_card_directory, file_type_set):
+        contents.update(folder_contents)
     return contents
 
 
-def find_existing_images(file_paths, db_path, method="filename"):
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
+class IndexSnapshot:
+    """Filenames and fingerprints of photo_index held in memory for checking cards without queries.
+
+    Each value is kept as a sorted array of its 64-bit hash(), about 8 bytes
+    per row, so a million-image library fits in a few tens of MB and a lookup is
+    a binary search. The odds of two names sharing a hash are negligible, so
+    filename lookups are answered from the snapshot alone. A fingerprint hit
+    still has its content compared in SQLite. The snapshot is reloaded when
+    the database or its WAL file changes on disk, on a thread of its own
+    connections (see refresh_in_background), and answers from the last load
+    meanwhile. db_path may be a list of shards, which are loaded into one
+    snapshot.
+    """
+
+    def __init__(self, db_path):
+        self.databases = shard_paths(db_path)
+        self.lock = threading.Lock()
+        self.loading = False
+        # Of the databases when the current contents were loaded, None until then
+        self.signature = None
+        self.filenames = array("q")
+        self.fingerprints = array("q")
+        # Rows indexed before fingerprints, matched on file size instead
+        self.unfingerprinted_sizes = set()
+
+    def database_signature(self):
+        signature = []
+        for path in [file for db in self.databases for file in (db, db + "-wal")]:
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def refresh(self):
+        """Reload the snapshot if the database changed since it was loaded."""
+        with self.lock:
+            signature = self.database_signature()
+            if self.signature is not None and self.signature == signature:
+                return
+            stats.count("snapshot_loads")
+
+            filenames = []
+            fingerprints = []
+            unfingerprinted_sizes = set()
+            # Not through an IndexReader, whose lookups would wait for the load
+            for cursor, schema in shard_cursors(self.databases):
+                cursor.execute(f"SELECT DISTINCT filename FROM {schema}.photo_index")
+                filenames.extend(hash(row[0]) for row in cursor)
+                cursor.execute(
+                    f"SELECT fingerprint FROM {schema}.photo_index WHERE fingerprint IS NOT NULL"
+                )
+                fingerprints.extend(hash(row[0]) for row in cursor)
+                cursor.execute(
+                    f"SELECT DISTINCT file_size FROM {schema}.photo_index WHERE fingerprint IS NULL"
+                )
+                unfingerprinted_sizes.update(row[0] for row in cursor)
+            self.filenames = array("q", sorted(filenames))
+            self.fingerprints = array("q", sorted(fingerprints))
+            self.unfingerprinted_sizes = unfingerprinted_sizes
+            self.signature = signature
+
+    def refresh_in_background(self):
+        """Start a refresh on another thread if the database changed, unless one is running already."""
+        if self.loading or self.signature == self.database_signature():
+            return
+        self.loading = True
 
+        def load():
+            try:
+                self.refresh()
+            except sqlite3.Error as e:
+                print(f"Error loading the index snapshot: {e}")
+            finally:
+                self.loading = False
+
+        threading.Thread(target=load, daemon=True).start()
+
+    @staticmethod
+    def contains(keys, value):
+        key = hash(value)
+        position = bisect_left(keys, key)
+        return position < len(keys) and keys[position] == key
+
+    def has_filename(self, file_path):
+        return self.contains(self.filenames, os.path.basename(file_path))
+
+    def may_have_content(self, file_path):
+        """Return False if file_path certainly isn't in the index, True if its content needs comparing."""
+        file_size = os.path.getsize(file_path)
+        if file_size in self.unfingerprinted_sizes or None in self.unfingerprinted_sizes:
+            return True
+        return self.contains(self.fingerprints, compute_fingerprint(file_path, file_size))
+
+
+def find_date_coverage(files_by_date, db_path, reader=None):
+    """Return {date: (imported, total, folders)} for the RAW files of each capture date of a card.
+
+    files_by_date is {datetime.date: [file_path, ...]}, as from group_by_date.
+    A file counts as imported if a file of the same name was indexed on the
+    same date or the day either side (to allow for time zones), and folders
+    are the library folders holding those files. Everything comes from
+    date_summary and folder_summary, with one query per table and shard,
+    run through reader if given.
+    """
+    filenames_by_date = {
+        date: {
+            os.path.basename(file)
+            for file in files
+            if file.lower().endswith(tuple(raw_extensions))
+        }
+        for date, files in files_by_date.items()
+    }
+    if not filenames_by_date:
+        return {}
+    nearby = {
+        date: [(date + timedelta(days=offset)).isoformat() for offset in (-1, 0, 1)]
+        for date in filenames_by_date
+    }
+    capture_dates = sorted({day for days in nearby.values() for day in days})
+    keys_by_date = defaultdict(set)
+    folders = []
+    for cursor, schema in shard_cursors(db_path, reader):
+        with stats.stage("sqlite_lookup"):
+            for chunk in chunked(capture_dates):
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(
+                    f"SELECT capture_date, filename_keys FROM {schema}.date_summary WHERE capture_date IN ({placeholders})",
+                    chunk,
+                )
+                for capture_date, filename_keys in cursor.fetchall():
+                    keys_by_date[capture_date].update(unpack_filename_keys(filename_keys))
+            cursor.execute(
+                f"""
+                SELECT folder, first_capture, last_capture, filename_keys FROM {schema}.folder_summary
+                WHERE first_capture < ? AND last_capture >= ?
+            """,
+                (
+                    (max(filenames_by_date) + timedelta(days=2)).isoformat(),
+                    capture_dates[0],
+                ),
+            )
+            folders.extend(
+                (folder, first[:10], last[:10], set(unpack_filename_keys(keys)))
+                for folder, first, last, keys in cursor.fetchall()
+            )
+
+    coverage = {}
+    for date, filenames in filenames_by_date.items():
+        indexed_keys = set().union(*(keys_by_date[day] for day in nearby[date]))
+        imported_keys = {
+            key for key in map(filename_key, filenames) if key in indexed_keys
+        }
+        date_folders = sorted(
+            {
+                folder
+                for folder, first, last, keys in folders
+                if first <= nearby[date][-1]
+                and last >= nearby[date][0]
+                and not keys.isdisjoint(imported_keys)
+            }
+        )
+        coverage[date] = (len(imported_keys), len(filenames), date_folders)
+    return coverage
+
+
+def coverage_status(imported, total):
+    if total and imported == total:
+        return "fully imported"
+    if imported:
+        return "partly imported"
+    return "not imported"
+
+
+def find_existing_images(file_paths, db_path, method="filename", snapshot=None, reader=None):
+    """Return (file_path, is_unique) for each RAW file in file_paths.
+
+    Pass every file on the card at once: they are checked with a few batched
+    queries rather than one query per file. db_path may be a list of shards,
+    which are checked together. With a loaded IndexSnapshot of db_path,
+    filename checks don't touch the database, and hash checks only query the
+    files whose fingerprint is in the snapshot; if the database has changed,
+    the snapshot reloads in the background and its last load is used
+    meanwhile. Filename checks go through reader, an IndexReader of db_path,
+    if given.
+
+    method="perceptual" counts a file as existing if a photo with a perceptual
+    hash within DEFAULT_PERCEPTUAL_DISTANCE bits is indexed, which catches
+    exports and re-encodes, and isn't fooled by cameras reusing filenames.
+    It needs PIL and the perceptual hashes from index --perceptual-hash.
+    """
+    file_paths = [
+        file
+        for file in file_paths
+        if any(file.lower().endswith(ext) for ext in raw_extensions)
+    ]
+    if method not in ("filename", "hash", "md5", "perceptual"):
+        raise ValueError("kwarg method must be either hash, md5, perceptual or filename")
+
+    if snapshot is not None and method != "perceptual":
+        snapshot.refresh_in_background()
+    if snapshot is not None and snapshot.signature is not None and method != "perceptual":
         if method == "filename":
-            filter_func = is_image_unique_by_name
-        elif method == "md5":
-            filter_func = is_image_unique_by_md5
-        else:
-            raise ValueError("kwarg method must be either md5 or filename")
-
-        file_paths = [
-            (file, filter_func(file, cursor))
-            for file in file_paths
-            if any(file.lower().endswith(ext) for ext in raw_extensions)
-        ]
+            stats.count("snapshot_lookups", len(file_paths))
+            return [(file, not snapshot.has_filename(file)) for file in file_paths]
+        candidates = [file for file in file_paths if snapshot.may_have_content(file)]
+        stats.count("snapshot_lookups", len(file_paths))
+        stats.count("snapshot_misses", len(file_paths) - len(candidates))
+        if not candidates:
+            return [(file, True) for file in file_paths]
+        file_paths_to_query = candidates
+    else:
+        file_paths_to_query = file_paths
+
+    shards = shard_paths(db_path)
+    if method == "filename" and reader is not None:
+        with reader.cursor() as cursor:
+            table = "all_photo_index" if len(reader.schemas) > 1 else "photo_index"
+            existing = find_indexed_filenames(cursor, file_paths_to_query, table)
+    elif method == "filename":
+        for shard in shards[1:]:
+            with closing(sqlite3.connect(shard)) as conn:
+                create_photo_index_table(conn.cursor())
+                conn.commit()
+        with closing(stats.trace_queries(sqlite3.connect(shards[0]))) as conn:
+            cursor = conn.cursor()
+            create_photo_index_table(cursor)
+            conn.commit()
+            table = "photo_index"
+            if len(shards) > 1:
+                attach_shards(conn, shards[1:])
+                table = "all_photo_index"
+            existing = find_indexed_filenames(cursor, file_paths_to_query, table)
+    elif method == "perceptual":
+        # Imported here as it needs PIL, which the other methods don't
+        from phash import compute_perceptual_hash
+
+        perceptual_hashes = {
+            file: compute_perceptual_hash(file) for file in file_paths_to_query
+        }
+        existing = set()
+        for shard in shards:
+            with closing(stats.trace_queries(sqlite3.connect(shard))) as conn:
+                cursor = conn.cursor()
+                create_photo_index_table(cursor)
+                conn.commit()
+                for file, perceptual_hash in perceptual_hashes.items():
+                    if (
+                        perceptual_hash is not None
+                        and file not in existing
+                        and find_similar_images(cursor, perceptual_hash)
+                    ):
+                        existing.add(file)
+    else:
+        # Content checks can update rows, so each shard is checked on its own connection
+        existing = set()
+        for shard in shards:
+            with closing(stats.trace_queries(sqlite3.connect(shard))) as conn:
+                cursor = conn.cursor()
+                create_photo_index_table(cursor)
+                existing.update(
+                    find_indexed_contents(
+                        cursor, [file for file in file_paths_to_query if file not in existing]
+                    )
+                )
+                conn.commit()
 
-    return file_paths
+    return [(file, file not in existing) for file in file_paths]
@@ -0,0 +1,172 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from utils import raw_extensions, walk_files
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def is_raw(file_path):
+    return any(file_path.lower().endswith(ext) for ext in raw_extensions)
+
+
+def outermost_folders(folders):
+    """Drop folders that are inside another of the folders, since indexing a folder covers its subfolders."""
+    outermost = []
+    for folder in sorted(folders, key=len):
+        if not any(folder.startswith(os.path.join(parent, "")) for parent in outermost):
+            outermost.append(folder)
+    return outermost
+
+
+class InotifyWatcher:
+    """Reports folders under directory whose RAW files were added, changed, moved or deleted.
+
+    Uses Linux inotify through libc, with one watch per folder since inotify
+    isn't recursive. Folders created or moved in are watched as they appear.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.add_tree(self.directory)
+
+    @staticmethod
+    def available():
+        if not sys.platform.startswith("linux"):
+            return False
+        try:
+            return hasattr(ctypes.CDLL(ctypes.util.find_library("c")), "inotify_init1")
+        except OSError:
+            return False
+
+    def add_tree(self, folder):
+        for subfolder, _, _ in walk_files(folder):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(subfolder), WATCH_MASK)
+            if wd < 0:
+                # Usually fs.inotify.max_user_watches; that folder is only caught by a full run
+                print(f"Can't watch {subfolder}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self.watches[wd] = subfolder
+
+    def remove_tree(self, folder):
+        prefix = os.path.join(folder, "")
+        for wd, watched in list(self.watches.items()):
+            if watched == folder or watched.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def changed_folders(self, timeout):
+        """Wait up to timeout seconds and return the set of folders that changed."""
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        data = os.read(self.fd, 64 * 1024)
+        position = 0
+        while position + EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, position)
+            position += EVENT_HEADER.size
+            name = os.fsdecode(data[position : position + name_length].rstrip(b"\0"))
+            position += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, so anything could have changed
+                changed.add(self.directory)
+                continue
+            folder = self.watches.get(wd)
+            if folder is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                    changed.add(path)
+                elif mask & IN_MOVED_FROM:
+                    # Its watches would otherwise keep reporting the old path
+                    self.remove_tree(path)
+                    changed.add(path)
+                elif mask & IN_DELETE:
+                    changed.add(path)
+            elif is_raw(name):
+                changed.add(folder)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Same interface as InotifyWatcher, but finds changes by listing directory every `interval` seconds.
+
+    Works on any platform and filesystem, including network drives, at the
+    cost of a stat of every RAW file per scan.
+    """
+
+    def __init__(self, directory, interval=60):
+        self.directory = os.path.abspath(directory)
+        self.interval = interval
+        self.listing = self.scan()
+        self.next_scan = time.monotonic() + interval
+
+    def scan(self):
+        """Return {folder: {file_path: (file_size, mtime)}} for the RAW files under directory."""
+        return {
+            folder: {
+                file_path: (stat.st_size, stat.st_mtime) for file_path, stat in files
+            }
+            for folder, files, _ in walk_files(self.directory)
+        }
+
+    def changed_folders(self, timeout):
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(wait, 0))
+        self.next_scan = time.monotonic() + self.interval
+
+        listing = self.scan()
+        changed = {
+            folder
+            for folder in listing.keys() | self.listing.keys()
+            if listing.get(folder) != self.listing.get(folder)
+        }
+        self.listing = listing
+        return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(directory, poll_interval=60, polling=False):
+    """Return an InotifyWatcher for directory where inotify is available, otherwise a PollingWatcher."""
+    if not polling and InotifyWatcher.available():
+        try:
+            return InotifyWatcher(directory)
+        except OSError as e:
+            print(f"inotify unavailable ({e}), polling every {poll_interval}s instead")
+    return PollingWatcher(directory, poll_interval)